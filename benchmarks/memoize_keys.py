@@ -0,0 +1,41 @@
+"""
+Compares @memoize key building modes on memory hits:
+
+    PYTHONPATH=. python benchmarks/memoize_keys.py
+"""
+from timeit import repeat
+
+from funcy import memoize
+
+
+def f(x, y=1, *, z=2):
+    return x + y + z
+
+default = memoize(f)
+normalized = memoize(normalize=True)(f)
+
+CALLS = [
+    ('f(1)', '(1)'),
+    ('f(1, 2)', '(1, 2)'),
+    ('f(1, y=2)', '(1, y=2)'),
+    ('f(1, y=2, z=3)', '(1, y=2, z=3)'),
+    ('f(x=1, y=2, z=3)', '(x=1, y=2, z=3)'),
+]
+
+def bench(number=300000):
+    print('%-20s %12s %12s' % ('call', 'default', 'normalize'))
+    for name, args in CALLS:
+        times = [min(repeat(func + args, globals=globals(), number=number, repeat=5))
+                 for func in ('default', 'normalized')]
+        print('%-20s %10.0fns %10.0fns' % (name, *(t / number * 1e9 for t in times)))
+
+    # Normalized keys also give less misses
+    for func in (default, normalized):
+        func.invalidate_all()
+        func(1), func(x=1), func(1, 1), func(1, y=1, z=2)
+    print('\nmemory size after equal calls: default %d, normalize %d'
+          % (len(default.memory), len(normalized.memory)))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,185 @@
+"""
+Coroutine versions of decorators, imported lazily by them to not import asyncio unless it's used.
+"""
+import asyncio
+import time
+
+from timeit import default_timer as timer
+
+from .primitives import EMPTY
+from .decorators import wraps
+from .calc import SkipMemory, CacheTTL, _CachedError, _store
+from .flow import _retry_delay, _DeferredCall
+
+
+def async_memory_wrapper(func, memory, get_key, stats, stale):
+    """Memoizes awaited results of a coroutine function.
+       Concurrent calls with the same key share a single in-flight task."""
+    flights = {}
+    call = func if stats is None else _count_calls(func, stats)
+
+    async def calc(key, args, kwargs):
+        started = timer()
+        try:
+            value = await call(*args, **kwargs)
+        except SkipMemory as e:
+            return e.args[0] if e.args else None
+        finally:
+            del flights[key]
+
+        # Cache memories use calculation time to expire results early and handle ttls
+        if hasattr(memory, 'store'):
+            return _store(memory, key, value, timer() - started)
+        memory[key] = value
+        return value
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = get_key(*args, **kwargs)
+        try:
+            value = memory[key]
+        except KeyError:
+            pass
+        else:
+            if stats is not None:
+                stats.hits += 1
+            return value
+
+        task = flights.get(key)
+        if task is None:
+            task = flights[key] = asyncio.ensure_future(calc(key, args, kwargs))
+            # Nobody awaits background refreshes, so mark their errors as retrieved
+            task.add_done_callback(_retrieve_exception)
+        if stale:
+            value = memory.get_stale(key, EMPTY)
+            if value is not EMPTY:
+                return value
+        # Shield shared task from being cancelled along with one of the awaiters
+        return await asyncio.shield(task)
+    return wrapper
+
+
+def _retrieve_exception(task):
+    if not task.cancelled():
+        task.exception()
+
+
+def async_warm(wrapper):
+    async def warm(args_seq):
+        await asyncio.gather(*(wrapper(*args) for args in args_seq))
+    return warm
+
+
+def async_caching_errors(func, errors, ttl):
+    @wraps(func)
+    async def caching(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except errors as e:
+            return CacheTTL(_CachedError(e, e.__traceback__), ttl)
+    return caching
+
+
+def async_reraising(func):
+    @wraps(func)
+    async def reraising(*args, **kwargs):
+        value = await func(*args, **kwargs)
+        if isinstance(value, _CachedError):
+            value.reraise()
+        return value
+    return reraising
+
+
+def _count_calls(func, stats):
+    async def counted(*args, **kwargs):
+        stats.misses += 1
+        started = timer()
+        try:
+            return await func(*args, **kwargs)
+        except SkipMemory:
+            stats.skips += 1
+            raise
+        finally:
+            stats.compute_time += timer() - started
+    return counted
+
+
+def async_retry(func, tries, errors, timeout, filter_errors, deadline, budget):
+    """Retries a coroutine function, sleeping with asyncio.sleep() between tries."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        give_up_at = None if deadline is None else time.monotonic() + deadline
+        for attempt in range(tries):
+            try:
+                result = await func(*args, **kwargs)
+            except errors as e:
+                delay = _retry_delay(e, attempt, tries, timeout, filter_errors,
+                                     give_up_at, budget)
+                if delay is None:
+                    raise
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                if budget is not None:
+                    budget.deposit()
+                return result
+    return wrapper
+
+
+def async_limit_error_rate(func, breaker, exception):
+    """Intercepts calls to a coroutine function with a circuit breaker."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not breaker.enter():
+            raise exception
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            breaker.failure()
+            raise
+        except BaseException:
+            # Cancellation is not a failure
+            breaker.release()
+            raise
+        breaker.success()
+        return result
+    return wrapper
+
+
+def async_limit_rate(func, limiter, wait, exception):
+    """Limits call rate of a coroutine function, waiting with asyncio.sleep()."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        delay = limiter.reserve(wait)
+        if delay is None:
+            raise exception
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return await func(*args, **kwargs)
+    return wrapper
+
+
+class AsyncDeferredCall(_DeferredCall):
+    """Schedules deferred calls of a coroutine function in a running asyncio loop."""
+    def _start_timer(self, delay, token):
+        return asyncio.get_event_loop().call_later(delay, self._fire, token)
+
+    def _call(self, args, kwargs):
+        # Keep a reference to not let the task be garbage collected
+        self.task = asyncio.ensure_future(self.func(*args, **kwargs))
+        return self.task
+
+
+def async_throttled(func, allowed):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if allowed(args, kwargs):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+def async_debounced(func, deferred, wait):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        deferred.schedule(wait, args, kwargs)
+    return wrapper
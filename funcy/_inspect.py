@@ -9,6 +9,13 @@ from .decorators import unwrap
 
 IS_PYPY = platform.python_implementation() == "PyPy"
 
+try:
+    from inspect import iscoroutinefunction as is_coroutine_function
+except ImportError:
+    # Python 3.4 has no coroutine functions
+    def is_coroutine_function(func):
+        return False
+
 # This provides sufficient introspection for *curry() functions.
 #
 # We only really need a number of required positional arguments.
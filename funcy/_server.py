@@ -0,0 +1,62 @@
+from multiprocessing.managers import BaseManager
+import threading
+
+from .calc import CacheMemory, LRUMemory
+
+
+class MemoryService(object):
+    """
+    Server side of ServerMemory.
+    Guarded by a lock since manager server handles each connection in a separate thread.
+    """
+    def __init__(self, timeout, maxsize):
+        if timeout is not None:
+            self._memory = CacheMemory(timeout, maxsize)
+        else:
+            self._memory = {} if maxsize is None else LRUMemory(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._memory[key]
+
+    def get_stale(self, key, default=None):
+        with self._lock:
+            return self._memory.get_stale(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+
+    def pop(self, key, *default):
+        with self._lock:
+            return self._memory.pop(key, *default)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._memory)
+
+    def len(self):
+        with self._lock:
+            return len(self._memory)
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+def get_service(name, timeout, maxsize):
+    with _services_lock:
+        if name not in _services:
+            _services[name] = MemoryService(timeout, maxsize)
+        return _services[name]
+
+
+class MemoryManager(BaseManager):
+    pass
+
+MemoryManager.register('memory', get_service,
+                       exposed=('get', 'get_stale', 'set', 'pop', 'clear', 'keys', 'len'))
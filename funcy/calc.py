@@ -1,13 +1,28 @@
 from datetime import timedelta
+import os
+import sys
 import time
 import inspect
-from collections import deque
-from bisect import bisect
+import pickle
+import threading
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import MutableMapping
+from heapq import heappush, heappop, heapify
+from math import log
+from random import random
+from itertools import count
+from collections import namedtuple
+from timeit import default_timer as timer
+import weakref
+from types import ModuleType, FunctionType, MethodType
 
+from .primitives import EMPTY
 from .decorators import wraps
+from ._inspect import is_coroutine_function
 
 
-__all__ = ['memoize', 'make_lookuper', 'silent_lookuper', 'cache']
+__all__ = ['memoize', 'make_lookuper', 'silent_lookuper', 'cache', 'DiskMemory',
+           'MemoryServer', 'ServerMemory']
 
 
 
@@ -15,34 +30,308 @@ class SkipMemory(Exception):
     pass
 
 
+class CacheTTL(object):
+    """Wraps a result to cache it for ttl seconds instead of a default timeout."""
+    __slots__ = ('value', 'ttl')
+
+    def __init__(self, value, ttl):
+        self.value = value
+        self.ttl = ttl.total_seconds() if isinstance(ttl, timedelta) else ttl
+
+
 # TODO: use pos-only arg once in Python 3.8+ only
-def memoize(_func=None, *, key_func=None):
-    """@memoize(key_func=None). Makes decorated function memoize its results.
+def memoize(_func=None, *, key_func=None, normalize=False, maxsize=None, max_bytes=None,
+            sizer=None, policy='lru', weak=False, single_flight=False, lazy=False, memory=None,
+            stats=False):
+    """@memoize(key_func=None, normalize=False, maxsize=None, max_bytes=None, sizer=None,
+                policy='lru', weak=False, single_flight=False, lazy=False, memory=None,
+                stats=False).
+    Makes decorated function memoize its results.
 
     If key_func is specified uses key_func(*func_args, **func_kwargs) as memory key.
-    Otherwise uses args + tuple(sorted(kwargs.items()))
+    Otherwise uses args + tuple(sorted(kwargs.items())), or all argument values
+    in signature order if normalize is set, so that f(1), f(x=1) share a key.
+
+    If maxsize is specified then no more than maxsize results are kept,
+    the rest are evicted according to policy, either 'lru' or 'lfu'.
+    Same for max_bytes, which limits total size of results as measured by sizer,
+    deep_sizeof() by default.
+    If weak is set then results are forgotten once the first argument is garbage collected.
+    Keys are normalized then, so that the first argument goes first even if passed by keyword.
+
+    If single_flight is set then concurrent calls with the same key wait for
+    the first one and share its result or exception.
 
-    Exposes its memory via .memory attribute.
+    If lazy is set then decorated function should return an iterable, which items are
+    remembered as they are consumed and replayed to subsequent callers.
+    Each call returns a new iterator then.
+
+    Custom memory, i.e. DiskMemory or any other mapping, could be passed via memory argument.
+    Exposes its memory via .memory attribute, which could be saved and restored
+    with .dump(file) and .load(file), and prefilled with .warm(args_seq, executor=None).
+
+    If stats is set then hits, misses, etc are counted and exposed via .cache_info().
     """
-    if _func is not None:
-        return memoize()(_func)
-    return _memory_decorator({}, key_func)
+    bounded = maxsize is not None or max_bytes is not None
+    if (memory is not None) + bounded + weak > 1:
+        raise ValueError("Pass only one of maxsize/max_bytes, weak or memory to @memoize()")
+    if weak:
+        memory = WeakMemory()
+    elif memory is None:
+        memory = _make_bounded_memory(maxsize, policy, max_bytes, sizer) if bounded else {}
+    decorator = _memory_decorator(memory, key_func, single_flight=single_flight, stats=stats,
+                                  normalize=normalize or weak and key_func is None, lazy=lazy,
+                                  weak=weak)
+    return decorator if _func is None else decorator(_func)
 
 memoize.skip = SkipMemory
+memoize.registry = _registry = weakref.WeakSet()
+
+
+def cache(timeout, *, key_func=None, normalize=False, maxsize=None, max_bytes=None, sizer=None,
+          backend=None, single_flight=False, stale_ttl=0, refresh=None, jitter=0, early=0,
+          cache_errors=None, error_ttl=None, stats=False):
+    """Caches a function results for timeout seconds.
+       Keeps up to maxsize results of up to max_bytes total size if these are specified,
+       evicting the ones expiring soonest.
+
+       To spread recalculations over time pass jitter, up to that many seconds are randomly
+       subtracted from timeout then. Or pass early, typically 1, to recalculate results
+       early with probability growing as expiration approaches and with calculation time.
 
+       If backend memory is specified then it's used as a second level behind
+       the in-process one, results are looked up and stored there as well.
 
-def cache(timeout, *, key_func=None):
-    """Caches a function results for timeout seconds."""
+       If stale_ttl is specified then expired results are still returned for that long,
+       while being recalculated in a background thread or refresh executor.
+
+       Decorated function could return cache.ttl(result, seconds) to cache a result
+       for a different time, this is then unwrapped.
+
+       If cache_errors, an exception class or a tuple of them, is specified then these
+       exceptions are cached and reraised, for error_ttl seconds if it's passed.
+
+       See @memoize() for the rest of params."""
     if isinstance(timeout, timedelta):
         timeout = timeout.total_seconds()
+    if isinstance(stale_ttl, timedelta):
+        stale_ttl = stale_ttl.total_seconds()
+    if isinstance(jitter, timedelta):
+        jitter = jitter.total_seconds()
+    if isinstance(error_ttl, timedelta):
+        error_ttl = error_ttl.total_seconds()
 
-    return _memory_decorator(CacheMemory(timeout), key_func)
+    memory = CacheMemory(timeout, maxsize, stale_ttl, max_bytes, sizer, jitter, early)
+    if backend is not None:
+        memory = TieredMemory(memory, backend)
+    return _memory_decorator(memory, key_func,
+                             single_flight=single_flight, stale=stale_ttl > 0, refresh=refresh,
+                             stats=stats, normalize=normalize,
+                             cache_errors=cache_errors, error_ttl=error_ttl)
 
 cache.skip = SkipMemory
+cache.ttl = CacheTTL
+cache.registry = _registry
+
+
+MemoryInfo = namedtuple('MemoryInfo',
+                        'hits misses skips evictions expirations compute_time size')
 
+class _Stats(object):
+    def __init__(self):
+        self.hits = self.misses = self.skips = 0
+        self.compute_time = 0.
+
+
+def _memory_decorator(memory, key_func, single_flight=False, stale=False, refresh=None,
+                      stats=False, normalize=False, lazy=False, cache_errors=None, error_ttl=None,
+                      weak=False):
+    if normalize and key_func:
+        raise ValueError("Pass either key_func or normalize, not both")
 
-def _memory_decorator(memory, key_func):
     def decorator(func):
+        if weak and not key_func and not _has_first_positional(func):
+            raise TypeError("@memoize(weak=True) needs a function with a positional parameter "
+                            "to refer weakly, %s() has none" % func.__name__)
+        func_key = _make_normalized_key(func) if normalize else key_func
+        get_key = func_key or _make_key
+        _stats = _Stats() if stats else None
+        call = _caching_errors(func, cache_errors, error_ttl) if cache_errors else func
+        if is_coroutine_function(func):
+            if refresh is not None or lazy:
+                raise ValueError("refresh and lazy are not supported for coroutine functions")
+            # Coroutines share in-flight calls anyway, so single_flight is implied here
+            from ._async import async_memory_wrapper
+            wrapper = async_memory_wrapper(call, memory, get_key, _stats, stale)
+        elif lazy:
+            # Memory keeps replay buffers, while callers get their own iterators over them
+            memoized = _memory_wrapper(_replaying(call, memory, get_key), memory, func_key, _stats,
+                                       single_flight, stale, refresh)
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                return iter(memoized(*args, **kwargs))
+        else:
+            wrapper = _memory_wrapper(call, memory, func_key, _stats, single_flight, stale, refresh)
+        if cache_errors:
+            wrapper = _reraising(wrapper)
+
+        def invalidate(*args, **kwargs):
+            memory.pop(get_key(*args, **kwargs), None)
+        wrapper.invalidate = invalidate
+
+        def invalidate_all():
+            memory.clear()
+        wrapper.invalidate_all = invalidate_all
+
+        def dump(file):
+            _dump_memory(memory, file)
+        wrapper.dump = dump
+
+        def load(file):
+            _load_memory(memory, file)
+        wrapper.load = load
+
+        if is_coroutine_function(func):
+            from ._async import async_warm
+            wrapper.warm = async_warm(wrapper)
+        else:
+            def warm(args_seq, executor=None):
+                if executor is None:
+                    for args in args_seq:
+                        wrapper(*args)
+                else:
+                    # Wait for all the calls to propagate errors
+                    list(executor.map(lambda args: wrapper(*args), args_seq))
+            wrapper.warm = warm
+
+        if stats:
+            def cache_info():
+                return MemoryInfo(_stats.hits, _stats.misses, _stats.skips,
+                                  getattr(memory, 'evictions', 0),
+                                  getattr(memory, 'expirations', 0),
+                                  _stats.compute_time, len(memory))
+            wrapper.cache_info = cache_info
+
+        wrapper.memory = memory
+        _registry.add(wrapper)
+        return wrapper
+    return decorator
+
+
+def _dump_memory(memory, file):
+    if isinstance(memory, WeakMemory):
+        raise TypeError("Can't dump weak memory, objects its keys refer to won't be alive on load")
+    items = []
+    for key in list(memory):
+        try:
+            value = memory[key]
+        except KeyError:
+            continue  # Expired or evicted meanwhile
+        # Errors are cached for a short time, which is not kept in a dump
+        if isinstance(value, _CachedError):
+            continue
+        # Only fully consumed lazy results are dumped, these are replayed from a list on load
+        if isinstance(value, _Replay):
+            value = value.consumed()
+            if value is None:
+                continue
+        items.append((key, value))
+    if hasattr(file, 'write'):
+        pickle.dump(items, file, protocol=4)
+    else:
+        with open(file, 'wb') as f:
+            pickle.dump(items, f, protocol=4)
+
+def _load_memory(memory, file):
+    if hasattr(file, 'read'):
+        items = pickle.load(file)
+    else:
+        with open(file, 'rb') as f:
+            items = pickle.load(f)
+    memory.update(items)
+
+
+def _make_key(*args, **kwargs):
+    return args + tuple(sorted(kwargs.items())) if kwargs else args
+
+def _has_first_positional(func):
+    P = inspect.Parameter
+    params = list(inspect.signature(func).parameters.values())
+    return bool(params) and params[0].kind in (P.POSITIONAL_ONLY, P.POSITIONAL_OR_KEYWORD)
+
+def _make_normalized_key(func):
+    """
+    Makes key func not distinguishing positional and keyword passed arguments,
+    as well as omitted and passed default values. It's generated with the same signature
+    as func, so that arguments are bound by Python itself, which is much faster than
+    doing that in a loop, and keys are built without sorting unless func has **kwargs.
+    """
+    P = inspect.Parameter
+    # Positional only args could not be named in Python 3.7 and earlier, so we rename them,
+    # to have same keys for calls in any Python version
+    params = [p.replace(name='__arg%d' % i) if p.kind == P.POSITIONAL_ONLY else p
+              for i, p in enumerate(inspect.signature(func).parameters.values())]
+    namespace = {'__sorted_items': lambda kwargs: tuple(sorted(kwargs.items()))}
+    signature, posargs, varargs, kwonlyargs, varkw = [], [], None, [], None
+    for p in params:
+        if p.kind == P.VAR_POSITIONAL:
+            signature.append('*' + p.name)
+            varargs = p.name
+            continue
+        elif p.kind == P.VAR_KEYWORD:
+            signature.append('**' + p.name)
+            varkw = p.name
+            continue
+        elif p.kind == P.KEYWORD_ONLY:
+            if not kwonlyargs and varargs is None:
+                signature.append('*')
+            kwonlyargs.append(p.name)
+        else:
+            posargs.append(p.name)
+        if p.default is P.empty:
+            signature.append(p.name)
+        else:
+            namespace['__default_' + p.name] = p.default
+            signature.append('%s=__default_%s' % (p.name, p.name))
+
+    key = '(%s)' % ''.join(name + ', ' for name in posargs)
+    if varargs:
+        key += ' + ' + varargs
+    if kwonlyargs:
+        key += ' + (%s)' % ''.join(name + ', ' for name in kwonlyargs)
+    if varkw:
+        key = '%s + __sorted_items(%s) if %s else %s' % (key, varkw, varkw, key)
+    name = func.__name__ if func.__name__.isidentifier() else 'key_func'
+    exec('def %s(%s):\n    return %s' % (name, ', '.join(signature), key), namespace)
+    return namespace[name]
+
+def _memory_wrapper(func, memory, key_func, stats, single_flight, stale, refresh):
+    call = func if stats is None else _count_calls(func, stats)
+
+    # Cache memories use calculation time to expire results early and handle ttls
+    if hasattr(memory, 'store'):
+        def calc(key, args, kwargs):
+            started = timer()
+            try:
+                value = call(*args, **kwargs)
+            except SkipMemory as e:
+                return e.args[0] if e.args else None
+            return _store(memory, key, value, timer() - started)
+    else:
+        def calc(key, args, kwargs):
+            try:
+                value = memory[key] = call(*args, **kwargs)
+                return value
+            except SkipMemory as e:
+                return e.args[0] if e.args else None
+
+    if single_flight:
+        calc = _single_flight(calc, memory)
+    if stale:
+        calc = _stale_while_revalidate(calc, memory, refresh)
+
+    if stats is None:
         @wraps(func)
         def wrapper(*args, **kwargs):
             # We inline this here since @memoize also targets microoptimizations
@@ -51,95 +340,1064 @@ def _memory_decorator(memory, key_func):
             try:
                 return memory[key]
             except KeyError:
-                try:
-                    value = memory[key] = func(*args, **kwargs)
-                    return value
-                except SkipMemory as e:
-                    return e.args[0] if e.args else None
-
-        def invalidate(*args, **kwargs):
+                return calc(key, args, kwargs)
+    else:
+        # A separate version to not slow down the one above
+        @wraps(func)
+        def wrapper(*args, **kwargs):
             key = key_func(*args, **kwargs) if key_func else \
                   args + tuple(sorted(kwargs.items())) if kwargs else args
-            memory.pop(key, None)
-        wrapper.invalidate = invalidate
+            try:
+                value = memory[key]
+            except KeyError:
+                return calc(key, args, kwargs)
+            stats.hits += 1
+            return value
+    return wrapper
 
-        def invalidate_all():
-            memory.clear()
-        wrapper.invalidate_all = invalidate_all
 
-        wrapper.memory = memory
-        return wrapper
-    return decorator
+def _store(memory, key, value, delta):
+    if isinstance(value, CacheTTL):
+        memory.store(key, value.value, delta=delta, ttl=value.ttl)
+        return value.value
+    memory.store(key, value, delta=delta)
+    return value
+
+
+def _count_calls(func, stats):
+    def counted(*args, **kwargs):
+        stats.misses += 1
+        started = timer()
+        try:
+            return func(*args, **kwargs)
+        except SkipMemory:
+            stats.skips += 1
+            raise
+        finally:
+            stats.compute_time += timer() - started
+    return counted
+
+
+class _CachedError(object):
+    __slots__ = ('error', 'traceback')
+
+    def __init__(self, error, traceback=None):
+        self.error = error
+        self.traceback = traceback
+
+    def __reduce__(self):
+        # Tracebacks are not picklable
+        return _CachedError, (self.error,)
+
+    def reraise(self):
+        # Restore original traceback to not grow it with each raise
+        raise self.error.with_traceback(self.traceback)
+
+
+def _caching_errors(func, errors, ttl):
+    if is_coroutine_function(func):
+        from ._async import async_caching_errors
+        return async_caching_errors(func, errors, ttl)
+
+    @wraps(func)
+    def caching(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except errors as e:
+            return CacheTTL(_CachedError(e, e.__traceback__), ttl)
+    return caching
+
+def _reraising(func):
+    if is_coroutine_function(func):
+        from ._async import async_reraising
+        return async_reraising(func)
+
+    @wraps(func)
+    def reraising(*args, **kwargs):
+        value = func(*args, **kwargs)
+        if isinstance(value, _CachedError):
+            value.reraise()
+        return value
+    return reraising
+
+
+def _replaying(func, memory, get_key):
+    @wraps(func)
+    def replaying(*args, **kwargs):
+        def forget():
+            # Forget failed replay so that next call recalculates it
+            key = get_key(*args, **kwargs)
+            try:
+                if memory[key] is replay:
+                    memory.pop(key, None)
+            except KeyError:
+                pass
+
+        replay = _Replay(func(*args, **kwargs), on_error=forget)
+        return replay
+    return replaying
+
+
+class _Replay(object):
+    """
+    An iterable lazily filled from a source iterator. Consumed items are kept,
+    so that each iteration replays them and then continues consuming the source.
+    Safe to iterate from several threads, source is advanced by one at a time.
+    An error raised by source is reraised to all the consumers reaching it,
+    on_error() is called once it happens.
+    """
+    def __init__(self, iterable, on_error=None):
+        self._source = iter(iterable)
+        self._items = []
+        self._error = None
+        self._on_error = on_error
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        items = self._items
+        i = 0
+        while True:
+            # Appending to a list is atomic, so we only lock to advance the source
+            if i == len(items):
+                with self._lock:
+                    if i == len(items) and not self._advance():
+                        break
+            yield items[i]
+            i += 1
+        if self._error is not None:
+            error, traceback = self._error
+            raise error.with_traceback(traceback)
+
+    def consumed(self):
+        """Returns all the items if source is exhausted without an error, None otherwise."""
+        if self._source is None and self._error is None:
+            return list(self._items)
+
+    def _advance(self):
+        if self._source is None:
+            return False
+        try:
+            self._items.append(next(self._source))
+            return True
+        except StopIteration:
+            self._source = None
+            return False
+        except BaseException as e:
+            # Failed source won't produce anything, it just stops
+            self._source = None
+            self._error = e, e.__traceback__
+            if self._on_error:
+                self._on_error()
+            return False
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = self.error = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def _single_flight(calc, memory):
+    """Makes concurrent calcs for the same key wait for the first one and share its result."""
+    lock = threading.Lock()
+    flights = {}
+
+    def single_calc(key, args, kwargs):
+        with lock:
+            # Flight might have landed since memory was checked
+            try:
+                return memory[key]
+            except KeyError:
+                pass
+            flight = flights.get(key)
+            if flight is None:
+                flight = flights[key] = _Flight()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            return flight.result()
+
+        try:
+            flight.value = calc(key, args, kwargs)
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with lock:
+                del flights[key]
+            flight.done.set()
+
+    return single_calc
+
+
+def _stale_while_revalidate(calc, memory, executor):
+    """Makes calc return a stale value if there is one, while recalculating it in background."""
+    lock = threading.Lock()
+    refreshing = set()
+
+    def refresh(key, args, kwargs):
+        try:
+            calc(key, args, kwargs)
+        finally:
+            with lock:
+                refreshing.discard(key)
+
+    def stale_calc(key, args, kwargs):
+        value = memory.get_stale(key, EMPTY)
+        if value is EMPTY:
+            return calc(key, args, kwargs)
+
+        with lock:
+            if key in refreshing:
+                return value
+            refreshing.add(key)
+        if executor is None:
+            threading.Thread(target=refresh, args=(key, args, kwargs), daemon=True).start()
+        else:
+            executor.submit(refresh, key, args, kwargs)
+        return value
+
+    return stale_calc
+
+
+def _make_bounded_memory(maxsize, policy, max_bytes=None, sizer=None):
+    try:
+        memory_cls = BOUNDED_MEMORIES[policy]
+    except KeyError:
+        raise ValueError("Unknown eviction policy %r, should be one of: %s"
+                         % (policy, ', '.join(sorted(BOUNDED_MEMORIES))))
+    return memory_cls(maxsize, max_bytes, sizer)
+
+
+def deep_sizeof(obj):
+    """Approximates memory taken by an object along with everything it contains."""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__') and not isinstance(obj, _SHARED_TYPES):
+            stack.append(obj.__dict__)
+    return total
+
+# Do not count these as contents of objects referring to them
+_SHARED_TYPES = (type, ModuleType, FunctionType, MethodType)
+
+
+# Number of recent reads remembered by bounded memories between writes
+READS_BUFFER_SIZE = 1024
+
+
+class _SizeLimit(object):
+    """
+    Limits number of items to maxsize and their total size to max_bytes if these are specified.
+    Sizes of values are measured with sizer.
+
+    Writes are serialized with a lock, reads are not, see subclasses.
+    """
+    def _init_limits(self, maxsize, max_bytes, sizer):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.sizer = sizer or deep_sizeof
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._reset_sizes()
+
+    def _fits(self, size):
+        """Checks whether an item of this size fits into an empty memory."""
+        return self.maxsize != 0 and (self.max_bytes is None or size <= self.max_bytes)
+
+    def _reject(self, key):
+        # Drop the old value since it's outdated anyway
+        self.pop(key, None)
+        self.evictions += 1
+
+    def _overflows(self, items=0, nbytes=0):
+        return self.maxsize is not None and len(self) + items > self.maxsize \
+            or self.max_bytes is not None and self.nbytes + nbytes > self.max_bytes
+
+    def _sizeof(self, value):
+        return self.sizer(value) if self.max_bytes is not None else 0
+
+    def _add_size(self, key, size):
+        if size:
+            self.nbytes += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+
+    def _drop_size(self, key):
+        self.nbytes -= self._sizes.pop(key, 0)
+
+    def _reset_sizes(self):
+        self.nbytes = 0
+        self._sizes = {}
+
+
+class LRUMemory(_SizeLimit, dict):
+    """Keeps up to maxsize items of up to max_bytes total size,
+       evicting least recently used ones.
+       Items are kept in a plain dict for fast reads, while their order is tracked aside.
+       Reads don't take a lock, they are recorded and reordering is done on next write,
+       so only the last READS_BUFFER_SIZE of them affect eviction."""
+    def __init__(self, maxsize=None, max_bytes=None, sizer=None):
+        self._init_limits(maxsize, max_bytes, sizer)
+        self._reads = deque(maxlen=READS_BUFFER_SIZE)
+        self.clear()
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        self._reads.append(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if not self._fits(size):
+                return self._reject(key)
+            self._apply_reads()
+            self._add_size(key, size)
+            dict.__setitem__(self, key, value)
+            self._order[key] = None
+            self._order.move_to_end(key)
+            while self._overflows():
+                self.popitem()
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            dict.__delitem__(self, key)
+            del self._order[key]
+            self._drop_size(key)
+
+    def pop(self, key, default=EMPTY):
+        with self._lock:
+            if key in self:
+                del self._order[key]
+                self._drop_size(key)
+                return dict.pop(self, key)
+            elif default is EMPTY:
+                raise KeyError(key)
+            else:
+                return default
+
+    def popitem(self):
+        with self._lock:
+            if not self:
+                raise KeyError('popitem(): memory is empty')
+            key = next(iter(self._order))
+            return key, self.pop(key)
+
+    update = MutableMapping.update
+    setdefault = MutableMapping.setdefault
+
+    def clear(self):
+        with self._lock:
+            dict.clear(self)
+            self._order = OrderedDict()
+            self._reset_sizes()
+
+    def _apply_reads(self):
+        reads = self._reads
+        for _ in range(len(reads)):
+            key = reads.popleft()
+            if key in self._order:
+                self._order.move_to_end(key)
+
 
-class CacheMemory(dict):
-    def __init__(self, timeout):
+class LFUMemory(_SizeLimit, dict):
+    """Keeps up to maxsize items of up to max_bytes total size,
+       evicting least frequently used ones.
+       Ties are resolved by evicting least recently used of them.
+       Reads are counted without a lock on next write, same as in LRUMemory."""
+    def __init__(self, maxsize=None, max_bytes=None, sizer=None):
+        self._init_limits(maxsize, max_bytes, sizer)
+        self._reads = deque(maxlen=READS_BUFFER_SIZE)
+        self.clear()
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        self._reads.append(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if not self._fits(size):
+                return self._reject(key)
+            self._apply_reads()
+            if key in self:
+                self._touch(key)
+            else:
+                # Make room beforehand for a new item to not be evicted right away
+                while self._overflows(1, size):
+                    self.popitem()
+                    self.evictions += 1
+                self._freqs[key] = 1
+                self._buckets[1][key] = None
+                self._min_freq = 1
+            dict.__setitem__(self, key, value)
+            self._add_size(key, size)
+            while self._overflows():
+                self.popitem()
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            dict.__delitem__(self, key)
+            self._unlink(key)
+
+    def pop(self, key, default=EMPTY):
+        with self._lock:
+            if key in self:
+                self._unlink(key)
+                return dict.pop(self, key)
+            elif default is EMPTY:
+                raise KeyError(key)
+            else:
+                return default
+
+    def popitem(self):
+        with self._lock:
+            if not self:
+                raise KeyError('popitem(): memory is empty')
+            # Min frequency might get stale after arbitrary pops, restore it then
+            if self._min_freq not in self._buckets:
+                self._min_freq = min(self._buckets)
+            key = next(iter(self._buckets[self._min_freq]))
+            return key, self.pop(key)
+
+    update = MutableMapping.update
+    setdefault = MutableMapping.setdefault
+
+    def clear(self):
+        with self._lock:
+            dict.clear(self)
+            self._freqs = {}
+            self._buckets = defaultdict(OrderedDict)
+            self._min_freq = 0
+            self._reset_sizes()
+
+    def _apply_reads(self):
+        reads = self._reads
+        for _ in range(len(reads)):
+            key = reads.popleft()
+            if dict.__contains__(self, key):
+                self._touch(key)
+
+    def _touch(self, key):
+        freq = self._unlink(key, drop_size=False)
+        self._freqs[key] = freq + 1
+        self._buckets[freq + 1][key] = None
+        if freq == self._min_freq and freq not in self._buckets:
+            self._min_freq = freq + 1
+
+    def _unlink(self, key, drop_size=True):
+        if drop_size:
+            self._drop_size(key)
+        freq = self._freqs.pop(key)
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+        return freq
+
+BOUNDED_MEMORIES = {'lru': LRUMemory, 'lfu': LFUMemory}
+
+
+class WeakMemory(MutableMapping):
+    """
+    Keeps items by tuple keys, referring their first elements weakly.
+    Items are dropped once their first key element is garbage collected.
+    """
+    def __init__(self):
+        self._data = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return self._data[key[0]][key[1:]]
+
+    def __setitem__(self, key, value):
+        obj, rest = key[0], key[1:]
+        with self._lock:
+            try:
+                self._data[obj][rest] = value
+            except KeyError:
+                self._data[obj] = {rest: value}
+
+    def __delitem__(self, key):
+        obj, rest = key[0], key[1:]
+        with self._lock:
+            items = self._data[obj]
+            del items[rest]
+            if not items:
+                del self._data[obj]
+
+    def __iter__(self):
+        return ((obj,) + rest for obj, items in list(self._data.items()) for rest in list(items))
+
+    def __len__(self):
+        return sum(map(len, list(self._data.values())))
+
+    def clear(self):
+        self._data.clear()
+
+
+class TieredMemory(MutableMapping):
+    """
+    Two level memory, reading through a fast l1 memory to a slower l2 one,
+    and writing to both. Counts hits of each level in .l1_hits and .l2_hits.
+    """
+    def __init__(self, l1, l2):
+        self.l1 = l1
+        self.l2 = l2
+        self.l1_hits = self.l2_hits = self.misses = 0
+
+    def __getitem__(self, key):
+        try:
+            value = self.l1[key]
+        except KeyError:
+            pass
+        else:
+            self.l1_hits += 1
+            return value
+
+        try:
+            value = self.l2[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.l2_hits += 1
+        self.l1[key] = value
+        return value
+
+    def get_stale(self, key, default=None):
+        return self.l1.get_stale(key, default)
+
+    def __setitem__(self, key, value):
+        self.l1[key] = value
+        self.l2[key] = value
+
+    def store(self, key, value, **params):
+        self.l1.store(key, value, **params)
+        # l2 has its own timeout, so it can't keep items with a custom ttl or cached errors,
+        # which are transient, an older value is dropped to not outlive the new one
+        if params.get('ttl') is None and not isinstance(value, _CachedError):
+            self.l2[key] = value
+        else:
+            self.l2.pop(key, None)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, default=EMPTY):
+        # Pop from both to keep them coherent
+        value = EMPTY
+        for memory in (self.l1, self.l2):
+            try:
+                value = memory.pop(key)
+            except KeyError:
+                pass
+        if value is not EMPTY:
+            return value
+        elif default is EMPTY:
+            raise KeyError(key)
+        else:
+            return default
+
+    def __iter__(self):
+        # Some items, e.g. the ones with a custom ttl, are only kept in l1
+        seen = set()
+        for memory in (self.l1, self.l2):
+            for key in list(memory):
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def clear(self):
+        self.l1.clear()
+        self.l2.clear()
+
+    @property
+    def evictions(self):
+        return getattr(self.l1, 'evictions', 0)
+
+    @property
+    def expirations(self):
+        return getattr(self.l1, 'expirations', 0)
+
+
+class CacheMemory(_SizeLimit, dict):
+    """
+    Keeps items for timeout seconds and up to maxsize of them of up to max_bytes total size,
+    if these are specified. Items expiring soonest are evicted first.
+    Expired items are kept for stale_ttl more seconds to be accessible via .get_stale().
+
+    A different timeout could be passed to .store() as ttl for any item.
+    To spread expirations of items stored together, up to jitter seconds are randomly
+    subtracted from timeout. Items could also be reported missing early with probability
+    growing as expiration approaches and with time their calculation took, which is passed
+    to .store(). early is a multiplier for that time, see "Optimal Probabilistic Cache
+    Stampede Prevention" by Vattani et al.
+
+    Expiration times are kept in a heap, so that expired items are purged eagerly
+    on each write in amortized O(log n). Heap entries left by overwritten or popped keys
+    are skipped lazily and the heap is rebuilt once they start to dominate.
+    Writes are serialized with a lock, while reads of fresh items don't take it.
+    """
+    def __init__(self, timeout, maxsize=None, stale_ttl=0, max_bytes=None, sizer=None,
+                 jitter=0, early=0):
         self.timeout = timeout
+        self.stale_ttl = stale_ttl
+        self.jitter = jitter
+        self.early = early
+        self._init_limits(maxsize, max_bytes, sizer)
+        self.expirations = 0
         self.clear()
 
     def __setitem__(self, key, value):
-        expires_at = time.time() + self.timeout
-        dict.__setitem__(self, key, (value, expires_at))
-        self._keys.append(key)
-        self._expires.append(expires_at)
+        self.store(key, value)
+
+    def store(self, key, value, delta=0, ttl=None):
+        now = time.time()
+        expires_at = now + (self.timeout if ttl is None else ttl)
+        if self.jitter:
+            expires_at -= random() * self.jitter
+        size = self._sizeof(value)
+        with self._lock:
+            self._expire(now)
+            if not self._fits(size):
+                return self._reject(key)
+            self._add_size(key, size)
+            dict.__setitem__(self, key, (value, expires_at, delta * self.early))
+            heappush(self._heap, (expires_at, next(self._counter), key))
+
+            while self._overflows():
+                self.evictions += self._pop_soonest()
+            if len(self._heap) > 2 * len(self) + 1:
+                self._compact()
 
     def __getitem__(self, key):
-        value, expires_at = dict.__getitem__(self, key)
-        if expires_at <= time.time():
+        value, expires_at, early = dict.__getitem__(self, key)
+        now = time.time()
+        if expires_at <= now:
             self.expire()
             raise KeyError(key)
+        # Early expiration, note that -log(1 - random()) is exponentially distributed
+        if early and now - early * log(1 - random()) >= expires_at:
+            raise KeyError(key)
         return value
 
+    def get_stale(self, key, default=None):
+        entry = dict.get(self, key)
+        if entry is None or entry[1] + self.stale_ttl <= time.time():
+            return default
+        return entry[0]
+
+    def __delitem__(self, key):
+        with self._lock:
+            dict.__delitem__(self, key)
+            self._drop_size(key)
+
+    def pop(self, key, default=EMPTY):
+        with self._lock:
+            if key in self:
+                self._drop_size(key)
+                return dict.pop(self, key)[0]
+            elif default is EMPTY:
+                raise KeyError(key)
+            else:
+                return default
+
+    update = MutableMapping.update
+
     def expire(self):
-        i = bisect(self._expires, time.time())
-        for _ in range(i):
-            self._expires.popleft()
-            self.pop(self._keys.popleft(), None)
+        with self._lock:
+            self._expire(time.time())
+
+    def _expire(self, now):
+        heap = self._heap
+        purge_before = now - self.stale_ttl
+        while heap and heap[0][0] <= purge_before:
+            self.expirations += self._pop_soonest()
+
+    def _pop_soonest(self):
+        expires_at, _, key = heappop(self._heap)
+        entry = dict.get(self, key)
+        # Skip entries of overwritten or popped keys
+        if entry is not None and entry[1] == expires_at:
+            self.__delitem__(key)
+            return True
+        return False
+
+    def _compact(self):
+        self._heap = [(entry[1], next(self._counter), key) for key, entry in dict.items(self)]
+        heapify(self._heap)
 
     def clear(self):
-        dict.clear(self)
-        self._keys = deque()
-        self._expires = deque()
+        with self._lock:
+            dict.clear(self)
+            self._heap = []
+            self._counter = count()
+            self._reset_sizes()
+
+
+class DiskMemory(MutableMapping):
+    """
+    Persistent memory storing pickled items in an sqlite database at path.
+    Expires items after timeout and keeps up to maxsize of them if these are specified,
+    evicting the ones written earliest.
+    Several memories could share a file by using different tables.
+    """
+    def __init__(self, path, maxsize=None, table='memory', timeout=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.table = table
+        self.timeout = timeout
+        self.evictions = self.expirations = 0
+        self._lock = threading.Lock()
+        self._conn = self._pid = None
+
+    def __getitem__(self, key):
+        rows = self._execute('SELECT value FROM "{}" WHERE key = ? AND ' + _FRESH,
+                             _dumps(key), time.time())
+        if not rows:
+            raise KeyError(key)
+        return pickle.loads(rows[0][0])
+
+    def __setitem__(self, key, value):
+        key = _dumps(key)
+        now = time.time()
+        expires_at = None if self.timeout is None else now + self.timeout
+        with self._lock:
+            conn = self._connect()
+            # Other connections, possibly in other processes, write to the same table,
+            # so writing and evicting is done in a single transaction
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.timeout is not None:
+                    cursor = conn.execute(
+                        'DELETE FROM "{}" WHERE expires_at <= ?'.format(self.table), (now,))
+                    self.expirations += cursor.rowcount
+                # Replacing deletes the old row, so rowids follow write order
+                self._query('INSERT OR REPLACE INTO "{}" VALUES (?, ?, ?)',
+                            key, _dumps(value), expires_at)
+                if self.maxsize is not None:
+                    # Only the overflow is deleted, oldest first, walking the rowid index
+                    overflow = self._query('SELECT count(*) FROM "{}"')[0][0] - self.maxsize
+                    if overflow > 0:
+                        self._query('DELETE FROM "{0}" WHERE rowid IN '
+                                    '(SELECT rowid FROM "{0}" ORDER BY rowid LIMIT ?)', overflow)
+                        self.evictions += overflow
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def __delitem__(self, key):
+        with self._lock:
+            cursor = self._connect().execute(
+                'DELETE FROM "{}" WHERE key = ?'.format(self.table), (_dumps(key),))
+            if not cursor.rowcount:
+                raise KeyError(key)
+
+    def __iter__(self):
+        rows = self._execute('SELECT key FROM "{}" WHERE %s ORDER BY rowid' % _FRESH, time.time())
+        return (pickle.loads(key) for key, in rows)
+
+    def __len__(self):
+        return self._execute('SELECT count(*) FROM "{}" WHERE ' + _FRESH, time.time())[0][0]
+
+    def clear(self):
+        self._execute('DELETE FROM "{}"')
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = self._pid = None
+
+    def _execute(self, sql, *params):
+        with self._lock:
+            self._connect()
+            return self._query(sql, *params)
+
+    def _query(self, sql, *params):
+        return self._conn.execute(sql.format(self.table), params).fetchall()
+
+    def _connect(self):
+        # Reconnect in forked processes, sqlite connections should not be shared among them
+        if self._pid != os.getpid():
+            import sqlite3
+
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._query('CREATE TABLE IF NOT EXISTS "{}" '
+                        '(key BLOB PRIMARY KEY, value BLOB, expires_at REAL)')
+            self._query('CREATE INDEX IF NOT EXISTS "{0}_expires_at" ON "{0}" (expires_at)')
+            self._pid = os.getpid()
+        return self._conn
+
+_FRESH = '(expires_at IS NULL OR expires_at > ?)'
+
+
+class MemoryServer(object):
+    """
+    Keeps memories for ServerMemory clients from several processes.
+    Listens at address, which is either a unix socket path or a (host, port) pair.
+    """
+    def __init__(self, address, authkey=None):
+        # Imported lazily since multiprocessing.managers takes a while to import
+        from ._server import MemoryManager
+        self._manager = MemoryManager(address, authkey=authkey)
+
+    @property
+    def address(self):
+        return self._manager.address
+
+    def start(self):
+        """Starts server in a separate process."""
+        self._manager.start()
+
+    def shutdown(self):
+        self._manager.shutdown()
+
+    def serve_forever(self):
+        self._manager.get_server().serve_forever()
+
+
+class ServerMemory(MutableMapping):
+    """
+    Memory kept by a MemoryServer at address, shared by all processes connecting to it
+    with the same name. Expires items after timeout and keeps up to maxsize of them
+    if these are specified.
+    """
+    def __init__(self, address, name, timeout=None, maxsize=None, authkey=None):
+        self.address = address
+        self.name = name
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.authkey = authkey
+        self._lock = threading.Lock()
+        self._proxy = self._pid = None
+
+    def __getitem__(self, key):
+        return self._connect().get(key)
+
+    def get_stale(self, key, default=None):
+        return self._connect().get_stale(key, default)
+
+    def __setitem__(self, key, value):
+        self._connect().set(key, value)
+
+    def __delitem__(self, key):
+        self._connect().pop(key)
+
+    def pop(self, key, default=EMPTY):
+        return self._connect().pop(key, *(() if default is EMPTY else (default,)))
+
+    def __iter__(self):
+        return iter(self._connect().keys())
+
+    def __len__(self):
+        return self._connect().len()
+
+    def clear(self):
+        self._connect().clear()
+
+    def _connect(self):
+        # Proxies should not be shared over forks, so reconnect in a new process
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    from ._server import MemoryManager
+
+                    manager = MemoryManager(self.address, authkey=self.authkey)
+                    manager.connect()
+                    self._proxy = manager.memory(self.name, self.timeout, self.maxsize)
+                    self._pid = os.getpid()
+        return self._proxy
+
+
+def _dumps(obj):
+    # Use fixed protocol to have same keys over different Python versions
+    return pickle.dumps(obj, protocol=4)
 
 
 def _make_lookuper(silent):
-    def make_lookuper(func):
+    # TODO: use pos-only arg once in Python 3.8+ only
+    def make_lookuper(_func=None, *, timeout=None, batch=False):
         """
         Creates a single argument function looking up result in a memory.
 
         Decorated function is called once on first lookup and should return all available
-        arg-value pairs.
+        arg-value pairs. If timeout is specified then the table is rebuilt in background
+        after that many seconds, lookups use the old one meanwhile.
+        A failed rebuild is retried after timeout again.
+
+        If batch is set then decorated function is called with a set of missing keys instead
+        and should return arg-value pairs for them, timeout then applies to each pair.
 
         Resulting function will raise LookupError when using @make_lookuper
         or simply return None when using @silent_lookuper.
+        Use its .many(keys) method to look up several keys at once.
         """
-        has_args, has_keys = has_arg_types(func)
-        assert not has_keys, \
-            'Lookup table building function should not have keyword arguments'
-
-        if has_args:
-            @memoize
-            def wrapper(*args):
-                f = lambda: func(*args)
-                f.__name__ = '%s(%s)' % (func.__name__, ', '.join(map(str, args)))
-                return make_lookuper(f)
-        else:
-            memory = {}
+        if isinstance(timeout, timedelta):
+            timeout = timeout.total_seconds()
 
-            def wrapper(arg):
-                if not memory:
-                    memory[object()] = None # prevent continuos memory refilling
-                    memory.update(func())
+        def decorator(func):
+            has_args, has_keys = has_arg_types(func)
+            assert not has_keys, \
+                'Lookup table building function should not have keyword arguments'
 
-                if silent:
-                    return memory.get(arg)
-                elif arg in memory:
-                    return memory[arg]
-                else:
-                    raise LookupError("Failed to look up %s(%s)" % (func.__name__, arg))
+            if batch:
+                assert has_args, 'Batch lookup function should accept a set of keys'
+                wrapper = _batch_lookuper(func, timeout, silent)
+            elif has_args:
+                @memoize
+                def wrapper(*args):
+                    f = lambda: func(*args)
+                    f.__name__ = '%s(%s)' % (func.__name__, ', '.join(map(str, args)))
+                    return make_lookuper(f, timeout=timeout)
+            else:
+                table = expires_at = None
+                lock = threading.Lock()
+
+                def load():
+                    nonlocal table, expires_at
+                    # Fill new table completely before swapping, so that lookups never see
+                    # a half-filled one
+                    new_table = dict(func())
+                    if timeout is not None:
+                        expires_at = time.time() + timeout
+                    table = new_table
+                    return new_table
+
+                def refresh():
+                    nonlocal expires_at
+                    try:
+                        load()
+                    except Exception:
+                        # Keep the old table and retry later, not on each lookup
+                        expires_at = time.time() + timeout
+                        raise
+                    finally:
+                        lock.release()
 
-        return wraps(func)(wrapper)
+                def get_table():
+                    current = table
+                    if current is None:
+                        with lock:
+                            current = table
+                            if current is None:
+                                current = load()
+                    # Only one refresh at a time, the lock is released once it's done
+                    elif lock.acquire(False):
+                        threading.Thread(target=refresh, daemon=True).start()
+                    return current
+
+                def wrapper(arg):
+                    current = table
+                    if current is None or timeout is not None and expires_at <= time.time():
+                        current = get_table()
+
+                    if silent:
+                        return current.get(arg)
+                    elif arg in current:
+                        return current[arg]
+                    else:
+                        raise LookupError("Failed to look up %s(%s)" % (func.__name__, arg))
+
+                def many(keys):
+                    current = table
+                    if current is None or timeout is not None and expires_at <= time.time():
+                        current = get_table()
+
+                    if silent:
+                        return list(map(current.get, keys))
+                    try:
+                        return list(map(current.__getitem__, keys))
+                    except KeyError as e:
+                        raise LookupError("Failed to look up %s(%s)" % (func.__name__, e.args[0]))
+                wrapper.many = many
+
+                def invalidate():
+                    nonlocal table
+                    table = None
+                wrapper.invalidate = wrapper.invalidate_all = invalidate
+
+            return wraps(func)(wrapper)
+
+        return decorator if _func is None else decorator(_func)
     return make_lookuper
 
+def _batch_lookuper(func, timeout, silent):
+    memory = {} if timeout is None else CacheMemory(timeout)
+
+    def load(keys):
+        values = dict(func(keys))
+        # Remember absent keys to not request them again
+        for key in keys:
+            values.setdefault(key, EMPTY)
+        memory.update(values)
+        return values
+
+    def resolve(key, value):
+        if value is not EMPTY:
+            return value
+        elif silent:
+            return None
+        else:
+            raise LookupError("Failed to look up %s(%s)" % (func.__name__, key))
+
+    def wrapper(arg):
+        try:
+            value = memory[arg]
+        except KeyError:
+            value = load({arg})[arg]
+        return resolve(arg, value)
+
+    def many(keys):
+        found, missing = {}, set()
+        keys = list(keys)
+        for key in keys:
+            try:
+                found[key] = memory[key]
+            except KeyError:
+                missing.add(key)
+        if missing:
+            found.update(load(missing))
+        return [resolve(key, found[key]) for key in keys]
+
+    def invalidate(arg):
+        memory.pop(arg, None)
+
+    wrapper.many = many
+    wrapper.invalidate = invalidate
+    wrapper.invalidate_all = memory.clear
+    wrapper.memory = memory
+    return wrapper
+
+
 make_lookuper = _make_lookuper(False)
 silent_lookuper = _make_lookuper(True)
 silent_lookuper.__name__ = 'silent_lookuper'
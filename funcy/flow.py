@@ -1,14 +1,20 @@
+from collections import deque
 from collections.abc import Hashable
-from datetime import datetime, timedelta
+from datetime import timedelta
+from fractions import Fraction
+import random
 import time
 import threading
 from contextlib import suppress  # reexport
 
 from .decorators import decorator, wraps, get_argnames, arggetter, contextmanager
+from ._inspect import is_coroutine_function
 
 
-__all__ = ['raiser', 'ignore', 'silent', 'suppress', 'nullcontext', 'reraise', 'retry', 'fallback',
-           'limit_error_rate', 'ErrorRateExceeded', 'throttle',
+__all__ = ['raiser', 'ignore', 'silent', 'suppress', 'nullcontext', 'reraise', 'retry', 'backoff',
+           'RetryBudget', 'fallback',
+           'limit_error_rate', 'ErrorRateExceeded', 'limit_rate', 'RateLimitExceeded',
+           'throttle', 'debounce',
            'post_processing', 'collecting', 'joining',
            'once', 'once_per', 'once_per_args',
            'wrap_with']
@@ -88,26 +94,119 @@ def reraise(errors, into):
         raise into from e
 
 
-@decorator
-def retry(call, tries, errors=Exception, timeout=0, filter_errors=None):
+def retry(tries, errors=Exception, timeout=0, filter_errors=None, deadline=None, budget=None):
     """Makes decorated function retry up to tries times.
        Retries only on specified errors.
-       Sleeps timeout or timeout(attempt) seconds between tries."""
+       Sleeps timeout or timeout(attempt) seconds between tries.
+       Gives up early if deadline seconds since the first try would pass while sleeping
+       or if RetryBudget passed as budget is exhausted.
+       Coroutine functions are retried without blocking the event loop."""
     errors = _ensure_exceptable(errors)
-    for attempt in range(tries):
-        try:
-            return call()
-        except errors as e:
-            if not (filter_errors is None or filter_errors(e)):
-                raise
-
-            # Reraise error on last attempt
-            if attempt + 1 >= tries:
-                raise
-            else:
-                timeout_value = timeout(attempt) if callable(timeout) else timeout
-                if timeout_value > 0:
-                    time.sleep(timeout_value)
+    if isinstance(deadline, timedelta):
+        deadline = deadline.total_seconds()
+
+    def decorator(func):
+        if is_coroutine_function(func):
+            from ._async import async_retry
+            return async_retry(func, tries, errors, timeout, filter_errors, deadline, budget)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            give_up_at = None if deadline is None else time.monotonic() + deadline
+            for attempt in range(tries):
+                try:
+                    result = func(*args, **kwargs)
+                except errors as e:
+                    delay = _retry_delay(e, attempt, tries, timeout, filter_errors,
+                                         give_up_at, budget)
+                    if delay is None:
+                        raise
+                    if delay > 0:
+                        time.sleep(delay)
+                else:
+                    if budget is not None:
+                        budget.deposit()
+                    return result
+        return wrapper
+    return decorator
+
+def _retry_delay(error, attempt, tries, timeout, filter_errors, give_up_at, budget):
+    """Returns number of seconds to sleep before next try or None to give up."""
+    if not (filter_errors is None or filter_errors(error)):
+        return None
+    # Reraise error on last attempt
+    if attempt + 1 >= tries:
+        return None
+    delay = timeout(attempt) if callable(timeout) else timeout
+    if give_up_at is not None and time.monotonic() + delay > give_up_at:
+        return None
+    # Withdraw last to not waste tokens on retries not made
+    if budget is not None and not budget.withdraw():
+        return None
+    return delay
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a ratio of successful calls, may be shared by several @retry.
+    Each success deposits ratio of a token and each retry withdraws one,
+    up to capacity tokens are kept. Starts full to allow some retries right away.
+    """
+    def __init__(self, ratio=0.1, capacity=10):
+        self.ratio = ratio
+        self.capacity = capacity
+        # Count exactly to not lose a token to float rounding,
+        # ratio is usually a float, so get back the decimal it was written as
+        self._deposit = Fraction(ratio).limit_denominator()
+        self._tokens = Fraction(capacity)
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        return float(self._tokens)
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self._deposit, self.capacity)
+
+    def withdraw(self):
+        """Takes a token for a retry, returns False if there are none."""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def backoff(base, cap=None, jitter=None):
+    """Makes exponential timeout for retry(), doubling base on each attempt up to cap.
+       Pass jitter='full' to randomize it between 0 and that
+       or jitter='decorrelated' to randomize it between base and 3 times bigger limit
+       on each attempt, so that failed callers don't retry simultaneously."""
+    if isinstance(base, timedelta):
+        base = base.total_seconds()
+    if isinstance(cap, timedelta):
+        cap = cap.total_seconds()
+    if jitter not in (None, 'full', 'decorrelated'):
+        raise ValueError("jitter should be one of None, 'full' or 'decorrelated'")
+
+    def timeout(attempt):
+        # Limit exponent to not overflow floats
+        attempt = min(attempt, 100)
+        if jitter == 'decorrelated':
+            limit = base * 3 ** (attempt + 1)
+        else:
+            limit = base * 2 ** attempt
+        if cap is not None:
+            limit = min(limit, cap)
+
+        if jitter == 'full':
+            return random.uniform(0, limit)
+        elif jitter == 'decorrelated':
+            return random.uniform(base, limit)
+        else:
+            return limit
+    return timeout
 
 
 def fallback(*approaches):
@@ -134,60 +233,378 @@ def _is_exception_type(value):
 class ErrorRateExceeded(Exception):
     pass
 
-def limit_error_rate(fails, timeout, exception=ErrorRateExceeded):
+def limit_error_rate(fails, timeout, exception=ErrorRateExceeded, *,
+                     window=None, rate=None, probes=1, on_change=None):
     """If function fails to complete fails times in a row,
-       calls to it will be intercepted for timeout with exception raised instead."""
-    if isinstance(timeout, int):
-        timeout = timedelta(seconds=timeout)
+       calls to it will be intercepted for timeout with exception raised instead.
+       If window is specified then fails within last window seconds are counted instead,
+       these should also make at least rate of calls if it's passed.
+       After timeout up to probes calls are let through, the first success closes
+       the circuit, while a failure opens it again. Probes not finished in another
+       timeout are not waited for, new ones are let through then.
+       on_change(old_state, new_state) is called on state changes,
+       which are 'closed', 'open' and 'half-open'."""
+    if isinstance(timeout, timedelta):
+        timeout = timeout.total_seconds()
+    if isinstance(window, timedelta):
+        window = window.total_seconds()
 
     def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            if wrapper.blocked:
-                if datetime.now() - wrapper.blocked < timeout:
+        breaker = _CircuitBreaker(fails, timeout, window, rate, probes, on_change)
+        if is_coroutine_function(func):
+            from ._async import async_limit_error_rate
+            wrapper = async_limit_error_rate(func, breaker, exception)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not breaker.enter():
                     raise exception
-                else:
-                    wrapper.blocked = None
-
-            try:
-                result = func(*args, **kwargs)
-            except:  # noqa
-                wrapper.fails += 1
-                if wrapper.fails >= fails:
-                    wrapper.blocked = datetime.now()
-                raise
-            else:
-                wrapper.fails = 0
+                try:
+                    result = func(*args, **kwargs)
+                except Exception:
+                    breaker.failure()
+                    raise
+                except BaseException:
+                    breaker.release()
+                    raise
+                breaker.success()
                 return result
 
-        wrapper.fails = 0
-        wrapper.blocked = None
+        wrapper.breaker = breaker
         return wrapper
     return decorator
 
 
-def throttle(period):
-    """Allows only one run in a period, the rest is skipped"""
+class _CircuitBreaker(object):
+    def __init__(self, fails, timeout, window=None, rate=None, probes=1, on_change=None):
+        self.max_fails = fails
+        self.timeout = timeout
+        self.window = window
+        self.rate = rate
+        self.probes = probes
+        self.on_change = on_change
+
+        self.state = 'closed'
+        self.fails = self.calls = 0
+        self._events = deque()  # (time, failed) pairs within window
+        self._opened_at = self._probing_since = None
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """Checks whether a call is allowed and registers a probe if it's one."""
+        change = None
+        with self._lock:
+            if self.state == 'open':
+                if time.monotonic() - self._opened_at < self.timeout:
+                    return False
+                change = self._set_state('half-open')
+            if self.state == 'half-open':
+                if self._probing < self.probes:
+                    self._probing += 1
+                    allowed = True
+                # Probes may hang on a dead service, let new ones through after timeout
+                elif time.monotonic() - self._probing_since >= self.timeout:
+                    self._probing = 1
+                    self._probing_since = time.monotonic()
+                    allowed = True
+                else:
+                    allowed = False
+            else:
+                allowed = True
+        self._notify(change)
+        return allowed
+
+    def success(self):
+        change = None
+        with self._lock:
+            if self.state == 'half-open':
+                change = self._set_state('closed')
+            elif self.window is None:
+                self.fails = 0
+            else:
+                self._record(False)
+        self._notify(change)
+
+    def failure(self):
+        change = None
+        with self._lock:
+            if self.state == 'half-open':
+                change = self._set_state('open')
+            elif self.state == 'closed':
+                if self.window is None:
+                    self.fails += 1
+                else:
+                    self._record(True)
+                if self._tripped():
+                    change = self._set_state('open')
+        self._notify(change)
+
+    def release(self):
+        """Frees a probe slot after an interrupted call."""
+        with self._lock:
+            if self.state == 'half-open' and self._probing:
+                self._probing -= 1
+
+    def _record(self, failed):
+        now = time.monotonic()
+        events = self._events
+        events.append((now, failed))
+        self.calls += 1
+        self.fails += failed
+        while events and events[0][0] <= now - self.window:
+            _, old_failed = events.popleft()
+            self.calls -= 1
+            self.fails -= old_failed
+
+    def _tripped(self):
+        return self.fails >= self.max_fails \
+            and (self.rate is None or self.fails >= self.rate * self.calls)
+
+    def _set_state(self, state):
+        old_state, self.state = self.state, state
+        self.fails = self.calls = self._probing = 0
+        self._events.clear()
+        if state == 'open':
+            self._opened_at = time.monotonic()
+        elif state == 'half-open':
+            self._probing_since = time.monotonic()
+        return old_state, state
+
+    def _notify(self, change):
+        # Called outside of lock to not deadlock if callback uses the decorated function
+        if change and self.on_change:
+            self.on_change(*change)
+
+
+class RateLimitExceeded(Exception):
+    """Raised by @limit_rate() instead of waiting."""
+
+def limit_rate(calls, period=1, *, burst=None, algorithm='token_bucket', wait=True,
+               exception=RateLimitExceeded):
+    """Limits decorated function to calls per period seconds.
+       With 'token_bucket' algorithm up to burst calls are allowed at once,
+       with 'sliding_window' no more than calls are made during any period.
+       Waits for the limit or raises exception instead if wait is False."""
     if isinstance(period, timedelta):
         period = period.total_seconds()
+    if algorithm not in ('token_bucket', 'sliding_window'):
+        raise ValueError("algorithm should be either 'token_bucket' or 'sliding_window'")
+    if algorithm == 'sliding_window' and burst is not None:
+        raise ValueError("burst is only supported by 'token_bucket' algorithm")
 
     def decorator(func):
+        if algorithm == 'token_bucket':
+            limiter = _TokenBucket(calls / period, burst or calls)
+        else:
+            limiter = _SlidingWindow(calls, period)
+        if is_coroutine_function(func):
+            from ._async import async_limit_rate
+            return async_limit_rate(func, limiter, wait, exception)
 
         @wraps(func)
         def wrapper(*args, **kwargs):
-            now = time.time()
-            if wrapper.blocked_until > now:
-                return
-            wrapper.blocked_until = now + period
-
+            delay = limiter.reserve(wait)
+            if delay is None:
+                raise exception
+            if delay > 0:
+                time.sleep(delay)
             return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _TokenBucket(object):
+    """Refills rate tokens per second up to capacity, a call takes one."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, wait):
+        """Takes a token, returns seconds to wait for it or None if not waiting."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1 and not wait:
+                return None
+            # Going negative reserves tokens for waiting calls in order
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+
+class _SlidingWindow(object):
+    """Keeps times of calls made during last period, including reserved future ones."""
+    def __init__(self, calls, period):
+        self.calls = calls
+        self.period = period
+        self._log = deque()
+        self._lock = threading.Lock()
+
+    def reserve(self, wait):
+        """Registers a call, returns seconds to wait for it or None if not waiting."""
+        with self._lock:
+            now = time.monotonic()
+            log = self._log
+            while log and log[0] <= now - self.period:
+                log.popleft()
+            if len(log) < self.calls:
+                log.append(now)
+                return 0
+            if not wait:
+                return None
+            at = log[-self.calls] + self.period
+            log.append(at)
+            return at - now
+
+
+def throttle(period, trailing=False):
+    """Allows only one run in a period, the rest is skipped.
+       If trailing is set then the last skipped call is made at the end of the period,
+       in a timer thread or in asyncio loop for coroutine functions."""
+    if isinstance(period, timedelta):
+        period = period.total_seconds()
+
+    def decorator(func):
+        lock = threading.Lock()
+        deferred = None
+        if trailing:
+            # Trailing call starts a new period
+            def run(*args, **kwargs):
+                with lock:
+                    wrapper.blocked_until = time.time() + period
+                return func(*args, **kwargs)
+            deferred = _make_deferred(func, run)
+
+        def allowed(args, kwargs):
+            with lock:
+                now = time.time()
+                if wrapper.blocked_until > now:
+                    if deferred:
+                        deferred.schedule(wrapper.blocked_until - now, args, kwargs,
+                                          reschedule=False)
+                    return False
+                wrapper.blocked_until = now + period
+            # This call is more recent than a skipped one, which was not made yet
+            if deferred:
+                deferred.cancel()
+            return True
+
+        if is_coroutine_function(func):
+            from ._async import async_throttled
+            wrapper = async_throttled(func, allowed)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if allowed(args, kwargs):
+                    return func(*args, **kwargs)
 
         wrapper.blocked_until = 0
+        if deferred:
+            wrapper.flush = deferred.flush
+            wrapper.cancel = deferred.cancel
         return wrapper
 
     return decorator
 
 
+def debounce(wait):
+    """Postpones calls until wait seconds pass since the last one,
+       then calls with the latest arguments in a timer thread,
+       or in asyncio loop for coroutine functions."""
+    if isinstance(wait, timedelta):
+        wait = wait.total_seconds()
+
+    def decorator(func):
+        deferred = _make_deferred(func, func)
+
+        if is_coroutine_function(func):
+            from ._async import async_debounced
+            wrapper = async_debounced(func, deferred, wait)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                deferred.schedule(wait, args, kwargs)
+
+        wrapper.flush = deferred.flush
+        wrapper.cancel = deferred.cancel
+        return wrapper
+    return decorator
+
+
+def _make_deferred(func, run):
+    if is_coroutine_function(func):
+        from ._async import AsyncDeferredCall
+        return AsyncDeferredCall(run)
+    return _DeferredCall(run)
+
+
+class _DeferredCall(object):
+    """
+    Calls func with the latest scheduled arguments once a timer fires or on .flush().
+    Rescheduling only moves the deadline, a single timer waits for it re-arming itself
+    if it fires early, to not start a timer thread per call.
+    """
+    def __init__(self, func):
+        self.func = func
+        self._lock = threading.Lock()
+        self._timer = self._token = None
+        self._deadline = None
+        self._pending = None
+
+    def schedule(self, delay, args, kwargs, reschedule=True):
+        with self._lock:
+            self._pending = (args, kwargs)
+            if self._timer is None:
+                self._deadline = time.monotonic() + delay
+                # Token tells a current timer from the stopped ones, which might still fire
+                self._token = object()
+                self._timer = self._start_timer(delay, self._token)
+            elif reschedule:
+                self._deadline = time.monotonic() + delay
+
+    def flush(self):
+        """Makes pending call right away, returns its result."""
+        with self._lock:
+            self._stop_timer()
+            pending, self._pending = self._pending, None
+        if pending is not None:
+            args, kwargs = pending
+            return self._call(args, kwargs)
+
+    def cancel(self):
+        """Drops pending call."""
+        with self._lock:
+            self._stop_timer()
+            self._pending = None
+
+    def _fire(self, token):
+        with self._lock:
+            if token is not self._token:
+                return
+            delay = self._deadline - time.monotonic()
+            if delay > 0:
+                self._timer = self._start_timer(delay, token)
+                return
+        self.flush()
+
+    def _start_timer(self, delay, token):
+        timer = threading.Timer(delay, self._fire, args=(token,))
+        timer.start()
+        return timer
+
+    def _stop_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = self._token = None
+
+    def _call(self, args, kwargs):
+        return self.func(*args, **kwargs)
+
+
 ### Post processing decorators
 
 @decorator
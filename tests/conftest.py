@@ -0,0 +1,21 @@
+import pytest
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fakes time.monotonic() and time.sleep(), current time is kept in clock[0]."""
+    now = [0]
+    monkeypatch.setattr('time.monotonic', lambda: now[0])
+
+    def sleep(seconds):
+        now[0] += seconds
+    monkeypatch.setattr('time.sleep', sleep)
+    return now
+
+
+@pytest.fixture
+def wall_clock(monkeypatch):
+    """Fakes time.time(), current time is kept in wall_clock[0]."""
+    now = [0]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    return now
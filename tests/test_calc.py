@@ -1,8 +1,19 @@
 from math import sin, cos
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import inspect
+import io
+import multiprocessing
+import random
+import sys
+import threading
+import time
 from datetime import timedelta
 import pytest
 
 from funcy.calc import *
+from funcy.calc import LRUMemory, LFUMemory, CacheMemory, BOUNDED_MEMORIES, deep_sizeof
 
 
 def test_memoize():
@@ -88,6 +99,818 @@ def test_memoize_key_func():
     assert calls == ['a', 'ab']
 
 
+def test_memoize_normalize():
+    @memoize(normalize=True)
+    def mul(x, by=1, *, power=1):
+        calls.append(x)
+        return (x * by) ** power
+
+    calls = []
+    assert mul(2) == 2
+    assert mul(x=2) == 2
+    assert mul(2, 1) == 2
+    assert mul(by=1, x=2, power=1) == 2
+    assert calls == [2]
+
+    assert mul(2, by=3) == 6
+    assert mul(2, 3, power=2) == 36
+    assert calls == [2, 2, 2]
+    assert set(mul.memory) == {(2, 1, 1), (2, 3, 1), (2, 3, 2)}
+
+    mul.invalidate(x=2, by=3)
+    assert set(mul.memory) == {(2, 1, 1), (2, 3, 2)}
+
+
+def test_memoize_normalize_varargs():
+    @memoize(normalize=True)
+    def join(sep, *parts, **kwargs):
+        calls.append(sep)
+        return sep.join(parts)
+
+    calls = []
+    assert join('-') == ''
+    assert join(sep='-') == ''
+    assert join('-', 'a', 'b') == 'a-b'
+    assert join('-', 'a', 'b', z=1, a=2) == 'a-b'
+    assert calls == ['-', '-', '-']
+    assert ('-', 'a', 'b', ('a', 2), ('z', 1)) in join.memory
+
+    with pytest.raises(ValueError): memoize(key_func=len, normalize=True)
+
+
+def test_memoize_normalize_signatures():
+    divmod_ = memoize(normalize=True)(divmod)  # Positional only args
+    assert divmod_(7, 2) == (3, 1)
+    assert list(divmod_.memory) == [(7, 2)]
+    with pytest.raises(TypeError): divmod_(x=7, y=2)
+
+    @memoize(normalize=True)
+    def shadowing(tuple, sorted=None, **kwargs):
+        return tuple
+
+    assert shadowing(1, x=2) == 1
+    assert list(shadowing.memory) == [(1, None, ('x', 2))]
+    with pytest.raises(TypeError): shadowing()
+
+
+def test_memoize_maxsize():
+    @memoize(maxsize=2)
+    def inc(x):
+        calls.append(x)
+        return x + 1
+
+    calls = []
+    inc(0)
+    inc(1)
+    inc(0)
+    inc(2)  # evicts 1 as least recently used
+    assert list(inc.memory) == [(0,), (2,)]
+    inc(0)
+    inc(1)
+    assert calls == [0, 1, 2, 1]
+
+
+def test_memoize_call_options():
+    inc = memoize(lambda x: x + 1, maxsize=2)
+    assert isinstance(inc.memory, LRUMemory)
+    for x in range(3):
+        inc(x)
+    assert list(inc.memory) == [(1,), (2,)]
+
+
+def test_memoize_lfu():
+    @memoize(maxsize=2, policy='lfu')
+    def inc(x):
+        calls.append(x)
+        return x + 1
+
+    calls = []
+    inc(0)
+    inc(0)
+    inc(1)
+    inc(2)  # evicts 1 as least frequently used
+    assert set(inc.memory) == {(0,), (2,)}
+    inc(0)
+    inc(1)
+    assert calls == [0, 1, 2, 1]
+
+    assert set(inc.memory) == {(0,), (1,)}
+
+    inc.invalidate(0)
+    inc.invalidate(0)
+    assert set(inc.memory) == {(1,)}
+    inc.invalidate_all()
+    assert not inc.memory
+
+
+def _run_threads(n, target):
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_memoize_single_flight():
+    calls = []
+    results = []
+
+    @memoize(single_flight=True)
+    def slow_inc(x):
+        calls.append(x)
+        time.sleep(0.05)
+        return x + 1
+
+    _run_threads(5, lambda: results.append(slow_inc(1)))
+    assert calls == [1]
+    assert results == [2] * 5
+    assert slow_inc(1) == 2
+
+
+def test_cache_single_flight_error():
+    calls = []
+    errors = []
+
+    @cache(60, single_flight=True)
+    def failing(x):
+        calls.append(x)
+        time.sleep(0.05)
+        raise ValueError(x)
+
+    def target():
+        try:
+            failing(1)
+        except ValueError as e:
+            errors.append(e)
+
+    _run_threads(5, target)
+    assert len(calls) < 5
+    assert len(errors) == 5
+    assert not failing.memory
+
+
+def test_memoize_async():
+    calls = []
+
+    @memoize
+    async def inc(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        if x == 2:
+            raise memoize.skip(42)
+        return x + 1
+
+    async def main():
+        assert await asyncio.gather(inc(0), inc(0), inc(1)) == [1, 1, 2]
+        assert await inc(0) == 1
+        assert await inc(2) == 42
+        assert await inc(2) == 42
+
+    assert inspect.iscoroutinefunction(inc)
+    asyncio.run(main())
+    assert calls == [0, 1, 2, 2]
+    assert inc.memory == {(0,): 1, (1,): 2}
+
+
+def test_cache_async_error():
+    calls = []
+
+    @cache(60)
+    async def failing(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        raise ValueError(x)
+
+    async def main():
+        results = await asyncio.gather(failing(1), failing(1), return_exceptions=True)
+        assert [type(r) for r in results] == [ValueError, ValueError]
+        with pytest.raises(ValueError):
+            await failing(1)
+
+    asyncio.run(main())
+    assert calls == [1, 1]
+    assert not failing.memory
+
+
+def test_cache_async_stale_error(wall_clock):
+    calls = []
+
+    @cache(10, stale_ttl=10)
+    async def get(x):
+        calls.append(x)
+        if len(calls) > 1:
+            raise ValueError(x)
+        return x
+
+    async def main():
+        handled = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, c: handled.append(c))
+        assert await get(1) == 1
+        wall_clock[0] = 12
+        assert await get(1) == 1  # stale, refresh fails in background
+        await asyncio.sleep(0.01)
+        gc.collect()
+        return handled
+
+    assert asyncio.run(main()) == []
+    assert calls == [1, 1]
+
+
+def test_memoize_async_unsupported():
+    async def f(x):
+        return x
+
+    with pytest.raises(ValueError):
+        memoize(lazy=True)(f)
+    with pytest.raises(ValueError):
+        cache(10, stale_ttl=5, refresh=ThreadPoolExecutor(1))(f)
+
+
+def test_memoize_stats():
+    @memoize(maxsize=2, stats=True)
+    def inc(x):
+        if x < 0:
+            raise memoize.skip
+        return x + 1
+
+    for x in [0, 1, 0, 2, -1]:
+        inc(x)
+    info = inc.cache_info()
+    assert info[:5] == (1, 4, 1, 1, 0)
+    assert info.size == 2
+    assert info.compute_time >= 0
+
+    assert inc in memoize.registry
+    assert not hasattr(memoize(lambda x: x), 'cache_info')
+
+
+def test_cache_stats(wall_clock):
+    @cache(10, stats=True)
+    def inc(x):
+        return x + 1
+
+    inc(0)
+    inc(0)
+    wall_clock[0] = 11
+    inc(1)
+    assert inc.cache_info()[:6] == (1, 2, 0, 0, 1, inc.cache_info().compute_time)
+    assert inc in cache.registry
+
+
+def test_memoize_async_stats():
+    @memoize(stats=True)
+    async def inc(x):
+        return x + 1
+
+    async def main():
+        await inc(0)
+        await inc(0)
+
+    asyncio.run(main())
+    assert inc.cache_info()[:3] == (1, 1, 0)
+
+
+def test_memoize_weak():
+    class Obj:
+        pass
+
+    @memoize(weak=True)
+    def describe(obj, prefix=''):
+        calls.append(obj)
+        return prefix + 'obj'
+
+    calls = []
+    a, b = Obj(), Obj()
+    assert describe(a) == 'obj'
+    assert describe(a) == 'obj'
+    assert describe(a, prefix='an ') == 'an obj'
+    assert describe(b) == 'obj'
+    assert calls == [a, a, b]
+    assert len(describe.memory) == 3
+
+    del calls[:]
+    del a
+    gc.collect()
+    assert list(describe.memory) == [(b, '')]
+
+    describe.invalidate(b)
+    assert len(describe.memory) == 0
+
+    with pytest.raises(TypeError): describe(1)
+    with pytest.raises(ValueError): memoize(weak=True, maxsize=10)
+
+
+def test_memoize_weak_keyword():
+    class Obj:
+        pass
+
+    @memoize(weak=True)
+    def describe(obj, prefix=''):
+        calls.append(obj)
+        return prefix + 'obj'
+
+    calls = []
+    a = Obj()
+    assert describe(obj=a) == 'obj'
+    assert describe(a) == 'obj'
+    assert describe(prefix='an ', obj=a) == 'an obj'
+    assert describe(a, 'an ') == 'an obj'
+    assert calls == [a, a]
+
+    del calls[:]
+    del a
+    gc.collect()
+    assert len(describe.memory) == 0
+
+
+def test_memoize_weak_no_args():
+    with pytest.raises(TypeError):
+        memoize(weak=True)(lambda: 42)
+    with pytest.raises(TypeError):
+        memoize(weak=True)(lambda *, x: x)
+    with pytest.raises(TypeError):
+        memoize(weak=True)(lambda *args: args)
+
+
+def test_memoize_weak_method():
+    class A:
+        @memoize(weak=True)
+        def value(self):
+            return object()
+
+    a = A()
+    assert a.value() is a.value()
+    del a
+    gc.collect()
+    assert len(A.value.memory) == 0
+
+
+def test_memoize_lazy():
+    calls = []
+
+    @memoize(lazy=True)
+    def squares(n):
+        for i in range(n):
+            calls.append(i)
+            yield i * i
+
+    it = squares(10)
+    assert next(it) == 0 and next(it) == 1
+    assert list(squares(10)) == [i * i for i in range(10)]
+    assert list(it) == [i * i for i in range(2, 10)]
+    assert list(squares(10)) == [i * i for i in range(10)]
+    assert calls == list(range(10))
+
+
+def test_memoize_lazy_error():
+    calls = []
+
+    @memoize(lazy=True)
+    def numbers():
+        calls.append(1)
+        yield 1
+        if len(calls) == 1:
+            raise IOError
+        yield 2
+
+    it = numbers()
+    it2 = numbers()
+    with pytest.raises(IOError): list(it)
+    with pytest.raises(IOError): list(it2)  # Shares the error
+    assert numbers.memory == {}
+    assert list(numbers()) == [1, 2]
+    assert list(numbers()) == [1, 2]
+    assert len(calls) == 2
+
+
+def test_memoize_lazy_threads():
+    @memoize(lazy=True)
+    def numbers():
+        for i in range(1000):
+            time.sleep(0)
+            yield i
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(list(numbers())))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [list(range(1000))] * 8
+
+
+def test_memoize_dump_load(tmp_path):
+    @memoize
+    def inc(x):
+        return x + 1
+
+    inc(1)
+    inc(2)
+    path = tmp_path / 'inc.pickle'
+    inc.dump(str(path))
+
+    @memoize
+    def failing_inc(x):
+        raise AssertionError("Should not be called")
+
+    failing_inc.load(str(path))
+    assert failing_inc(1) == 2
+    assert failing_inc(2) == 3
+
+
+def test_memoize_dump_lazy():
+    @memoize(lazy=True)
+    def numbers(n):
+        return iter(range(n))
+
+    list(numbers(2))
+    next(numbers(3))
+    f = io.BytesIO()
+    numbers.dump(f)
+    f.seek(0)
+    numbers.invalidate_all()
+    numbers.load(f)
+    assert list(numbers.memory) == [(2,)]
+    assert list(numbers(2)) == [0, 1]
+    assert list(numbers(2)) == [0, 1]
+
+    with pytest.raises(TypeError): memoize(weak=True)(lambda obj: obj).dump(io.BytesIO())
+
+
+def test_cache_dump_load(wall_clock):
+    @cache(10)
+    def inc(x):
+        return x + 1
+
+    inc(1)
+    wall_clock[0] = 5
+    inc(2)
+    wall_clock[0] = 12
+    f = io.BytesIO()
+    inc.dump(f)
+    f.seek(0)
+    inc.invalidate_all()
+    inc.load(f)
+    assert list(inc.memory) == [(2,)]
+
+
+def test_memoize_warm():
+    calls = []
+
+    @memoize
+    def add(x, y):
+        calls.append((x, y))
+        return x + y
+
+    add.warm([(1, 2), (3, 4)])
+    with ThreadPoolExecutor(2) as executor:
+        add.warm([(1, 2), (5, 6)], executor=executor)
+    assert sorted(calls) == [(1, 2), (3, 4), (5, 6)]
+    assert add(5, 6) == 11
+
+
+def test_memoize_async_warm():
+    calls = []
+
+    @memoize
+    async def inc(x):
+        calls.append(x)
+        return x + 1
+
+    asyncio.run(inc.warm([(1,), (2,)]))
+    assert calls == [1, 2]
+    assert asyncio.run(inc(1)) == 2
+    assert calls == [1, 2]
+
+
+def test_memoize_max_bytes():
+    @memoize(max_bytes=10, sizer=len)
+    def repeat(s, n):
+        return s * n
+
+    repeat('a', 4)
+    repeat('b', 4)
+    assert repeat.memory.nbytes == 8
+    repeat('c', 4)  # evicts 'a'
+    assert list(repeat.memory) == [('b', 4), ('c', 4)]
+    repeat('d', 11)  # too big to keep
+    assert list(repeat.memory) == [('b', 4), ('c', 4)]
+    repeat.invalidate_all()
+    assert repeat.memory.nbytes == 0
+
+
+def test_memoize_lfu_max_bytes():
+    @memoize(max_bytes=10, sizer=len, policy='lfu')
+    def repeat(s, n):
+        return s * n
+
+    repeat('a', 4)
+    repeat('a', 4)
+    repeat('b', 4)
+    repeat('c', 4)  # evicts 'b'
+    assert set(repeat.memory) == {('a', 4), ('c', 4)}
+    repeat('d', 11)  # too big to keep
+    assert set(repeat.memory) == {('a', 4), ('c', 4)}
+    repeat.invalidate('a', 4)
+    assert repeat.memory.nbytes == 4
+
+
+def test_cache_max_bytes():
+    @cache(60, max_bytes=10, sizer=len)
+    def repeat(s, n):
+        return s * n
+
+    repeat('a', 4)
+    repeat('b', 4)
+    repeat('c', 4)  # evicts 'a' as expiring soonest
+    assert set(repeat.memory) == {('b', 4), ('c', 4)}
+    repeat.invalidate('b', 4)
+    assert repeat.memory.nbytes == 4
+
+
+def test_lru_memory_sizes():
+    memory = LRUMemory(max_bytes=100, sizer=len)
+    memory['a'] = 'x' * 10
+    memory['a'] = 'x' * 20
+    memory['b'] = 'x' * 30
+    assert memory.nbytes == 50
+    del memory['a']
+    assert memory.popitem() == ('b', 'x' * 30)
+    assert memory.nbytes == 0
+
+
+def test_deep_sizeof():
+    class A:
+        def __init__(self, data):
+            self.data = data
+
+    data = ['x' * 1000]
+    assert deep_sizeof(data) > 1000
+    assert deep_sizeof(A(data)) > deep_sizeof(data)
+    assert deep_sizeof([data, data]) < 2 * deep_sizeof(data)
+
+
+def _stress(memory, get_value, threads=8, ops=3000):
+    errors = []
+
+    def work(seed):
+        rnd = random.Random(seed)
+        try:
+            for _ in range(ops):
+                key = rnd.randrange(50)
+                op = rnd.random()
+                if op < 0.6:
+                    assert get_value(memory, key) in (None, key)
+                elif op < 0.95:
+                    memory[key] = key
+                else:
+                    memory.pop(key, None)
+        except Exception as e:
+            errors.append(e)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert not errors
+
+
+def _get(memory, key):
+    try:
+        return memory[key]
+    except KeyError:
+        return None
+
+
+@pytest.mark.parametrize('policy', ['lru', 'lfu'])
+def test_bounded_memory_threads(policy):
+    memory = BOUNDED_MEMORIES[policy](maxsize=20, max_bytes=40, sizer=lambda v: v % 5 + 1)
+    _stress(memory, _get)
+
+    keys = set(dict.keys(memory))
+    assert len(keys) <= 20
+    assert set(memory._sizes) == keys
+    assert memory.nbytes == sum(k % 5 + 1 for k in keys) <= 40
+    if policy == 'lfu':
+        assert set(memory._freqs) == keys
+        assert sum(map(len, memory._buckets.values())) == len(keys)
+
+
+def test_cache_memory_threads():
+    memory = CacheMemory(0.001, maxsize=20)
+    _stress(memory, _get)
+
+    entries = dict(dict.items(memory))
+    assert len(entries) <= 20
+    heap_entries = {(key, expires_at) for expires_at, _, key in memory._heap}
+    assert all((key, entry[1]) in heap_entries for key, entry in entries.items())
+
+
+def test_memoize_threads():
+    @memoize(maxsize=20)
+    def ident(x):
+        return x
+
+    _stress(ident.memory, lambda _, key: ident(key))
+    assert len(ident.memory) <= 20
+
+
+def test_memoize_bad_policy():
+    with pytest.raises(ValueError): memoize(maxsize=2, policy='random')
+
+
+def test_lfu_memory():
+    memory = LFUMemory(3)
+    memory.update({'a': 1, 'b': 2, 'c': 3})
+    assert memory['a'] == 1
+    assert memory['b'] == 2
+    del memory['c']
+    memory.pop('a')
+    assert memory.popitem() == ('b', 2)
+    with pytest.raises(KeyError): memory.popitem()
+
+
+def test_memoize_memory_param():
+    memory = {}
+
+    @memoize(memory=memory)
+    def inc(x):
+        return x + 1
+
+    inc(0)
+    assert inc.memory is memory
+    assert memory == {(0,): 1}
+
+    with pytest.raises(ValueError): memoize(maxsize=2, memory={})
+
+
+def test_disk_memory(tmp_path):
+    path = str(tmp_path / 'memory.db')
+    calls = []
+
+    def inc(x, by=1):
+        calls.append(x)
+        return x + by
+
+    inc1 = memoize(memory=DiskMemory(path))(inc)
+    assert inc1(0) == 1
+    assert inc1(0, by=2) == 2
+    assert inc1(0) == 1
+    assert calls == [0, 0]
+    inc1.memory.close()
+
+    # Survives "restart"
+    inc2 = memoize(memory=DiskMemory(path))(inc)
+    assert inc2(0) == 1
+    assert calls == [0, 0]
+    assert len(inc2.memory) == 2
+
+    inc2.invalidate(0)
+    inc2.invalidate(0)
+    assert list(inc2.memory) == [(0, ('by', 2))]
+    inc2.invalidate_all()
+    assert len(inc2.memory) == 0
+    inc2.memory.close()
+
+
+def test_disk_memory_maxsize(tmp_path):
+    memory = DiskMemory(str(tmp_path / 'memory.db'), maxsize=2)
+    memory['a'] = 1
+    memory['b'] = 2
+    memory['a'] = 3  # rewrite makes 'b' the oldest
+    memory['c'] = 4
+    assert dict(memory) == {'a': 3, 'c': 4}
+    with pytest.raises(KeyError): memory['b']
+    with pytest.raises(KeyError): del memory['b']
+    memory.close()
+
+
+def test_disk_memory_maxsize_shared(tmp_path):
+    path = str(tmp_path / 'memory.db')
+    first, second = DiskMemory(path, maxsize=3), DiskMemory(path, maxsize=3)
+    for i in range(5):
+        first[i] = i
+        second[i + 10] = i
+    assert len(first) == len(second) == 3
+    assert list(first) == [13, 4, 14]
+    first.close()
+    second.close()
+
+
+def test_disk_memory_maxsize_cost(tmp_path):
+    # Evicting from a full memory should not walk the whole table
+    def write_cost(maxsize):
+        memory = DiskMemory(str(tmp_path / ('memory%d.db' % maxsize)), maxsize=maxsize)
+        for i in range(maxsize):
+            memory[i] = i
+        steps = []
+        memory._conn.set_progress_handler(lambda: steps.append(1), 1)
+        memory['new'] = 1
+        memory._conn.set_progress_handler(None, 1)
+        assert len(memory) == maxsize and memory.evictions == 1
+        memory.close()
+        return len(steps)
+
+    assert write_cost(1000) < 2 * write_cost(10)
+
+
+def test_disk_memory_timeout(tmp_path, wall_clock):
+    memory = DiskMemory(str(tmp_path / 'memory.db'), timeout=10)
+    memory['a'] = 1
+    wall_clock[0] = 5
+    memory['b'] = 2
+    wall_clock[0] = 10
+    with pytest.raises(KeyError): memory['a']
+    assert list(memory) == ['b']
+    memory['c'] = 3
+    assert memory.expirations == 1
+    memory.close()
+
+
+def test_cache_backend(tmp_path, wall_clock):
+    calls = []
+
+    def inc(x):
+        calls.append(x)
+        return x + 1
+
+    # Emulate two processes sharing a disk memory
+    backend = DiskMemory(str(tmp_path / 'memory.db'), timeout=100)
+    inc1 = cache(10, backend=backend)(inc)
+    inc2 = cache(10, backend=backend)(inc)
+
+    assert inc1(0) == 1
+    assert inc2(0) == 1
+    assert inc2(0) == 1
+    assert calls == [0]
+    assert (inc2.memory.l1_hits, inc2.memory.l2_hits, inc2.memory.misses) == (1, 1, 0)
+
+    wall_clock[0] = 50  # Expired in l1, but not in l2
+    assert inc1(0) == 1
+    assert calls == [0]
+    wall_clock[0] = 150
+    assert inc1(0) == 1
+    assert calls == [0, 0]
+
+    inc1.invalidate(0)
+    assert 0 not in inc1.memory.l1 and len(backend) == 0
+    inc1.invalidate(0)
+    backend.close()
+
+
+@pytest.fixture
+def memory_server(tmp_path):
+    server = MemoryServer(str(tmp_path / 'memory.sock'))
+    server.start()
+    yield server
+    server.shutdown()
+
+
+def _double(x):
+    _double.calls += 1
+    return x * 2
+
+
+def _check_shared(memory, calls):
+    _double.calls = 0
+    double = memoize(memory=memory)(_double)
+    assert double(1) == 2 and double(2) == 4
+    assert _double.calls == calls
+
+
+def test_server_memory(memory_server):
+    memory = ServerMemory(memory_server.address, 'double')
+    _check_shared(memory, calls=2)
+
+    memory.pop((2,))
+    with pytest.raises(KeyError): memory.pop((2,))
+    assert memory.pop((2,), None) is None
+    assert list(memory) == [(1,)]
+
+    # Another process sees the same memory and fills it back
+    process = multiprocessing.Process(target=_check_shared, args=(memory, 1))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert len(memory) == 2
+
+    # Different names are separate
+    assert not ServerMemory(memory_server.address, 'other')
+
+
+def test_server_memory_timeout(memory_server):
+    memory = ServerMemory(memory_server.address, 'double', timeout=0)
+    memory[1] = 2
+    with pytest.raises(KeyError): memory[1]
+
+
 def test_make_lookuper():
     @make_lookuper
     def letter_index():
@@ -131,6 +954,150 @@ def test_silnent_lookuper_nested():
     assert function_table(cos)(-1) is None
 
 
+def test_lookuper_many():
+    @make_lookuper
+    def letter_index():
+        return ((c, i) for i, c in enumerate('abc'))
+
+    assert letter_index.many('cab') == [2, 0, 1]
+    with pytest.raises(LookupError): letter_index.many('a_')
+
+    @silent_lookuper
+    def silent_index():
+        return ((c, i) for i, c in enumerate('abc'))
+
+    assert silent_index.many('c_') == [2, None]
+
+
+def test_make_lookuper_batch():
+    calls = []
+
+    @make_lookuper(batch=True)
+    def square(keys):
+        calls.append(keys)
+        return {k: k * k for k in keys if k >= 0}
+
+    assert square(2) == 4
+    assert square.many([1, 2, 3]) == [1, 4, 9]
+    assert square.many([3, 1]) == [9, 1]
+    assert calls == [{2}, {1, 3}]
+
+    with pytest.raises(LookupError): square(-1)
+    with pytest.raises(LookupError): square.many([1, -1])
+    assert calls == [{2}, {1, 3}, {-1}]
+
+    square.invalidate(2)
+    assert square(2) == 4
+    assert calls[-1] == {2}
+
+
+def test_silent_lookuper_batch(wall_clock):
+    calls = []
+
+    @silent_lookuper(batch=True, timeout=60)
+    def square(keys):
+        calls.append(keys)
+        return {k: k * k for k in keys if k >= 0}
+
+    assert square.many([-1, 2]) == [None, 4]
+    wall_clock[0] = 30
+    assert square.many([2, 3]) == [4, 9]
+    wall_clock[0] = 70
+    assert square.many([2, 3]) == [4, 9]
+    assert calls == [{-1, 2}, {3}, {2}]
+
+
+def test_make_lookuper_invalidate():
+    calls = []
+
+    @make_lookuper
+    def letter_index():
+        calls.append(1)
+        return ((c, i) for i, c in enumerate('abc'))
+
+    assert letter_index('c') == 2
+    assert letter_index('a') == 0
+    letter_index.invalidate()
+    assert letter_index('c') == 2
+    assert len(calls) == 2
+
+
+def test_make_lookuper_nested_invalidate():
+    calls = []
+
+    @silent_lookuper
+    def function_table(f):
+        calls.append(f)
+        return ((x, f(x)) for x in range(10))
+
+    function_table(sin)(1)
+    function_table(cos)(1)
+    function_table.invalidate(sin)
+    function_table(sin)(1)
+    function_table(cos)(1)
+    assert calls == [sin, cos, sin]
+
+    function_table.invalidate_all()
+    function_table(cos)(1)
+    assert calls == [sin, cos, sin, cos]
+
+
+def test_make_lookuper_timeout(wall_clock):
+    building = threading.Event()
+    release = threading.Event()
+
+    @make_lookuper(timeout=60)
+    def table():
+        if wall_clock[0]:
+            building.set()
+            release.wait(1)
+        return {'now': wall_clock[0]}
+
+    assert table('now') == 0
+    wall_clock[0] = 61
+    assert table('now') == 0  # Old table is used while rebuilding
+    assert building.wait(1)
+    assert table('now') == 0
+
+    release.set()
+    for _ in range(100):
+        if table('now') == 61:
+            break
+        time.sleep(0.01)
+    assert table('now') == 61
+
+
+def test_make_lookuper_refresh_error(monkeypatch, wall_clock):
+    errors = []
+    monkeypatch.setattr('threading.excepthook', errors.append)
+    calls = []
+
+    @make_lookuper(timeout=60)
+    def table():
+        calls.append(wall_clock[0])
+        if 0 < wall_clock[0] < 120:
+            raise IOError
+        return {'now': wall_clock[0]}
+
+    def wait_refresh():
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and thread.daemon:
+                thread.join(1)
+
+    assert table('now') == 0
+    wall_clock[0] = 61
+    for _ in range(100):
+        assert table('now') == 0  # Old table is kept
+        wait_refresh()
+    assert calls == [0, 61]
+    assert len(errors) == 1
+
+    wall_clock[0] = 121
+    table('now')
+    wait_refresh()
+    assert table('now') == 121
+
+
 @pytest.mark.parametrize('typ',
     [pytest.param(int, id='int'), pytest.param(lambda s: timedelta(seconds=s), id='timedelta')])
 def test_cache(typ):
@@ -198,3 +1165,276 @@ def test_cache_invalidate():
     # ensure invalidate() is idempotent (doesn't raise KeyError on the 2nd call)
     inc.invalidate(0)
     inc.invalidate(0)
+
+
+def test_cache_maxsize():
+    calls = []
+
+    @cache(timeout=60, maxsize=2)
+    def inc(x):
+        calls.append(x)
+        return x + 1
+
+    inc(0)
+    inc(1)
+    inc(2)  # evicts 0 as expiring soonest
+    assert len(inc.memory) == 2
+    inc(1)
+    inc(0)
+    assert calls == [0, 1, 2, 0]
+
+
+def test_cache_memory_expire(wall_clock):
+    memory = CacheMemory(10)
+    memory['a'] = 1
+    wall_clock[0] = 5
+    memory['b'] = 2
+    wall_clock[0] = 11
+    memory['c'] = 3  # purges 'a' even though it is never read
+    assert set(memory) == {'b', 'c'}
+    with pytest.raises(KeyError): memory['a']
+
+    wall_clock[0] = 16
+    with pytest.raises(KeyError): memory['b']
+    assert set(memory) == {'c'}
+
+
+def test_cache_memory_reset(wall_clock):
+    memory = CacheMemory(10)
+    for i in range(1000):
+        wall_clock[0] = i / 100
+        memory['a'] = i
+        memory['b'] = i
+    assert memory['a'] == 999
+    assert len(memory._heap) <= 5
+
+    # Overwritten key is not expired by its stale expiration time
+    wall_clock[0] = 15
+    memory['a'] = 0
+    wall_clock[0] = 20
+    assert memory['a'] == 0
+    with pytest.raises(KeyError): memory['b']
+
+
+def test_cache_ttl(wall_clock):
+    calls = []
+
+    @cache(10, maxsize=2)
+    def get(x):
+        calls.append(x)
+        return cache.ttl(x, timedelta(seconds=x)) if x else x
+
+    assert [get(20), get(5), get(0)] == [20, 5, 0]
+    assert calls == [20, 5, 0]
+    assert set(get.memory) == {(20,), (0,)}  # Evicted one expiring soonest
+
+    wall_clock[0] = 11
+    assert [get(20), get(5), get(0)] == [20, 5, 0]
+    assert calls == [20, 5, 0, 5, 0]
+
+
+def test_cache_memory_ttl(wall_clock):
+    memory = CacheMemory(10)
+    memory.store('a', 1, ttl=30)
+    memory.store('b', 2, ttl=5)
+    memory['c'] = 3
+    wall_clock[0] = 6
+    memory['d'] = 4
+    assert set(memory) == {'a', 'c', 'd'}
+    wall_clock[0] = 20
+    memory['e'] = 5
+    assert set(memory) == {'a', 'e'}
+
+
+def test_cache_errors(wall_clock):
+    calls = []
+
+    @cache(10, cache_errors=LookupError, error_ttl=timedelta(seconds=2))
+    def get(x):
+        calls.append(x)
+        if x < 0:
+            raise KeyError(x)
+        elif x == 0:
+            raise ValueError(x)
+        return x
+
+    for _ in range(2):
+        with pytest.raises(KeyError): get(-1)
+        with pytest.raises(ValueError): get(0)
+        assert get(1) == 1
+    assert calls == [-1, 0, 1, 0]
+
+    wall_clock[0] = 3
+    with pytest.raises(KeyError): get(-1)
+    assert get(1) == 1
+    assert calls == [-1, 0, 1, 0, -1]
+
+
+def test_cache_backend_size():
+    @cache(10, backend={}, stats=True)
+    def inc(x):
+        return cache.ttl(x + 1, 5) if x else x + 1
+
+    inc(0)
+    inc(1)
+    inc.memory.l2[(2,)] = 3
+    assert inc.memory.l2 == {(0,): 1, (2,): 3}
+    assert sorted(inc.memory) == [(0,), (1,), (2,)]
+    assert inc.cache_info().size == 3
+
+
+def test_cache_errors_backend(wall_clock):
+    calls = []
+
+    @cache(10, cache_errors=KeyError, error_ttl=1, backend={})
+    def get(x):
+        calls.append(x)
+        if len(calls) == 1:
+            raise KeyError(x)
+        return cache.ttl(x, 5) if x else x
+
+    with pytest.raises(KeyError): get(1)
+    assert get.memory.l2 == {}
+    wall_clock[0] = 2
+    assert get(1) == 1
+    assert get.memory.l2 == {}  # Custom ttl values are not written to backend
+    assert get(0) == 0
+    assert get.memory.l2 == {(0,): 0}
+    assert calls == [1, 1, 0]
+
+
+def test_cache_errors_backend_default_ttl():
+    @cache(60, cache_errors=ValueError, backend={})
+    def check(x):
+        raise ValueError(x)
+
+    with pytest.raises(ValueError): check(1)
+    with pytest.raises(ValueError): check(1)
+    assert check.memory.l2 == {}
+    assert len(check.memory.l1) == 1
+
+
+def test_cache_errors_dump():
+    @cache(10, cache_errors=KeyError)
+    def get(x):
+        if x:
+            raise KeyError(x)
+        return x
+
+    get(0)
+    with pytest.raises(KeyError): get(1)
+    f = io.BytesIO()
+    get.dump(f)
+    f.seek(0)
+    get.invalidate_all()
+    get.load(f)
+    assert list(get.memory) == [(0,)]
+
+
+def test_cache_errors_traceback():
+    @cache(10, cache_errors=KeyError)
+    def get(x):
+        raise KeyError(x)
+
+    def depth(tb):
+        return 0 if tb is None else 1 + depth(tb.tb_next)
+
+    depths = []
+    for _ in range(3):
+        with pytest.raises(KeyError) as info:
+            get(1)
+        depths.append(depth(info.value.__traceback__))
+    assert depths[1] == depths[2]
+
+
+def test_cache_errors_async():
+    calls = []
+
+    @cache(10, cache_errors=KeyError)
+    async def get(x):
+        calls.append(x)
+        raise KeyError(x)
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(KeyError):
+                await get(1)
+
+    asyncio.run(main())
+    assert calls == [1]
+
+
+def test_cache_jitter(monkeypatch, wall_clock):
+    monkeypatch.setattr('funcy.calc.random', lambda: 0.5)
+
+    @cache(10, jitter=timedelta(seconds=4))
+    def inc(x):
+        return x + wall_clock[0]
+
+    assert inc(0) == 0
+    wall_clock[0] = 7
+    assert inc(0) == 0
+    wall_clock[0] = 8
+    assert inc(0) == 8
+
+
+def test_cache_memory_early(monkeypatch, wall_clock):
+    rand = [0.5]
+    monkeypatch.setattr('funcy.calc.random', lambda: rand[0])
+
+    memory = CacheMemory(10, early=2)
+    memory.store('a', 1, delta=1)
+    memory['b'] = 2
+    # Expires early when now - 2 * log(1 - rand) >= 10
+    wall_clock[0] = 8
+    assert memory['a'] == 1
+    rand[0] = 0.9
+    with pytest.raises(KeyError): memory['a']
+    assert memory['b'] == 2  # Calculation time unknown, no early expiration
+    assert set(memory) == {'a', 'b'}
+
+
+def test_cache_stale(wall_clock):
+    class DeferredExecutor:
+        jobs = []
+
+        def submit(self, f, *args):
+            self.jobs.append((f, args))
+
+    executor = DeferredExecutor()
+    calls = []
+
+    @cache(10, stale_ttl=5, refresh=executor)
+    def get(x):
+        calls.append(x)
+        return wall_clock[0]
+
+    assert get(1) == 0
+    wall_clock[0] = 12
+    assert get(1) == 0  # stale
+    assert get(1) == 0  # still stale, refresh is not resubmitted
+    assert len(executor.jobs) == 1 and calls == [1]
+
+    f, args = executor.jobs.pop()
+    f(*args)
+    assert get(1) == 12
+    assert calls == [1, 1]
+
+    wall_clock[0] = 30  # too stale
+    assert get(1) == 30
+    assert not executor.jobs
+
+
+def test_cache_stale_thread(wall_clock):
+    @cache(10, stale_ttl=5)
+    def get():
+        return wall_clock[0]
+
+    assert get() == 0
+    wall_clock[0] = 12
+    assert get() == 0
+    for _ in range(100):
+        if get() == 12:
+            break
+        time.sleep(0.01)
+    assert get() == 12
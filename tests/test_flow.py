@@ -1,4 +1,6 @@
+import asyncio
 from datetime import timedelta
+import threading
 import pytest
 from funcy.flow import *
 
@@ -107,6 +109,103 @@ def test_retry_timeout(monkeypatch):
     assert timeouts == [1, 2, 4]
 
 
+def test_retry_deadline(clock):
+    def failing():
+        clock[0] += 1
+        raise MyError
+
+    with pytest.raises(MyError):
+        retry(10, MyError, timeout=2, deadline=timedelta(seconds=10))(failing)()
+    assert clock[0] == 10  # 1 + 2 + 1 + 2 + 1 + 2 + 1, next sleep would pass deadline
+
+
+def test_retry_async(monkeypatch):
+    timeouts = []
+
+    async def sleep(seconds):
+        timeouts.append(seconds)
+    monkeypatch.setattr('asyncio.sleep', sleep)
+
+    calls = []
+
+    @retry(3, MyError, timeout=lambda a: 2 ** a)
+    async def failing(x):
+        calls.append(x)
+        raise MyError
+
+    with pytest.raises(MyError):
+        asyncio.run(failing(42))
+    assert calls == [42] * 3
+    assert timeouts == [1, 2]
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, capacity=2)
+    calls = []
+
+    @retry(3, MyError, budget=budget)
+    def failing():
+        calls.append('f')
+        raise MyError
+
+    @retry(3, MyError, budget=budget)
+    def working():
+        calls.append('w')
+
+    with pytest.raises(MyError):
+        failing()
+    assert calls == ['f'] * 3
+    assert budget.tokens == 0
+
+    with pytest.raises(MyError):
+        failing()
+    assert calls == ['f'] * 4
+
+    working()
+    working()
+    assert budget.tokens == 1
+    del calls[:]
+    with pytest.raises(MyError):
+        failing()
+    assert calls == ['f'] * 2
+
+
+def test_retry_budget_capacity():
+    budget = RetryBudget(ratio=0.1, capacity=1)
+    for _ in range(20):
+        budget.deposit()
+    assert budget.tokens == 1
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    for _ in range(10):
+        budget.deposit()
+    assert budget.withdraw()
+
+
+@pytest.mark.parametrize('ratio, capacity, deposits', [(0.3, 3, 10), (0.7, 10, 10), (0.35, 7, 20)])
+def test_retry_budget_inexact_ratio(ratio, capacity, deposits):
+    budget = RetryBudget(ratio, capacity)
+    assert sum(budget.withdraw() for _ in range(capacity + 1)) == capacity
+    for _ in range(deposits):
+        budget.deposit()
+    assert sum(budget.withdraw() for _ in range(capacity + 1)) == round(deposits * ratio)
+
+
+def test_backoff(monkeypatch):
+    assert [backoff(1)(a) for a in range(4)] == [1, 2, 4, 8]
+    assert [backoff(1, cap=5)(a) for a in range(4)] == [1, 2, 4, 5]
+    assert backoff(1, cap=5)(10 ** 6) == 5
+
+    monkeypatch.setattr('random.uniform', lambda a, b: (a, b))
+    assert [backoff(1, cap=5, jitter='full')(a) for a in range(4)] \
+        == [(0, 1), (0, 2), (0, 4), (0, 5)]
+    assert [backoff(1, cap=20, jitter='decorrelated')(a) for a in range(3)] \
+        == [(1, 3), (1, 9), (1, 20)]
+
+    with pytest.raises(ValueError):
+        backoff(1, jitter='half')
+
+
 def test_retry_many_errors():
     assert retry(2, (MyError, RuntimeError))(_make_failing())() == 1
     assert retry(2, [MyError, RuntimeError])(_make_failing())() == 1
@@ -153,6 +252,198 @@ def test_limit_error_rate():
     assert calls == [1, 2]
 
 
+def test_limit_error_rate_half_open(clock):
+    changes = []
+    fail = [True]
+
+    @limit_error_rate(2, timedelta(seconds=10), MyError, on_change=lambda *c: changes.append(c))
+    def limited():
+        if fail[0]:
+            raise TypeError
+
+    for _ in range(2):
+        with pytest.raises(TypeError): limited()
+    with pytest.raises(MyError): limited()
+    assert limited.breaker.state == 'open'
+
+    # A failed probe opens circuit again
+    clock[0] = 10
+    with pytest.raises(TypeError): limited()
+    with pytest.raises(MyError): limited()
+
+    clock[0] = 20
+    fail[0] = False
+    limited()
+    limited()
+    assert changes == [('closed', 'open'), ('open', 'half-open'), ('half-open', 'open'),
+                       ('open', 'half-open'), ('half-open', 'closed')]
+
+
+def test_limit_error_rate_probes(clock):
+    started, release = threading.Event(), threading.Event()
+
+    @limit_error_rate(1, 10, MyError)
+    def limited(x):
+        if x == 'fail':
+            raise TypeError
+        started.set()
+        release.wait()
+
+    with pytest.raises(TypeError): limited('fail')
+    clock[0] = 10
+    probe = threading.Thread(target=limited, args=('wait',))
+    probe.start()
+    started.wait()
+    with pytest.raises(MyError): limited('other')  # Only one probe is let through
+    release.set()
+    probe.join()
+    assert limited.breaker.state == 'closed'
+
+
+def test_limit_error_rate_hanging_probe(clock):
+    started, release = threading.Event(), threading.Event()
+
+    @limit_error_rate(1, 10, MyError)
+    def limited(x):
+        if x == 'fail':
+            raise TypeError
+        if x == 'hang':
+            started.set()
+            release.wait()
+
+    with pytest.raises(TypeError): limited('fail')
+    clock[0] = 10
+    probe = threading.Thread(target=limited, args=('hang',), daemon=True)
+    probe.start()
+    started.wait()
+    try:
+        clock[0] = 19
+        with pytest.raises(MyError): limited('other')
+        clock[0] = 20
+        limited('other')  # Hanging probe is not waited for anymore
+        assert limited.breaker.state == 'closed'
+    finally:
+        release.set()
+        probe.join()
+
+
+def test_limit_error_rate_window(clock):
+    @limit_error_rate(2, 10, MyError, window=60, rate=0.5)
+    def limited(x):
+        if x:
+            raise TypeError
+
+    limited(0)
+    limited(0)
+    clock[0] = 30
+    with pytest.raises(TypeError): limited(1)
+    limited(0)
+    with pytest.raises(TypeError): limited(1)  # Only 2 of 5 calls failed
+    assert limited.breaker.state == 'closed'
+
+    clock[0] = 61  # First successes are out of window
+    with pytest.raises(TypeError): limited(1)
+    assert limited.breaker.state == 'open'
+    with pytest.raises(MyError): limited(0)
+
+
+def test_limit_error_rate_async():
+    @limit_error_rate(1, 60, MyError)
+    async def limited():
+        raise TypeError
+
+    async def main():
+        with pytest.raises(TypeError): await limited()
+        with pytest.raises(MyError): await limited()
+
+    asyncio.run(main())
+
+
+def test_limit_rate(clock):
+    starts = []
+
+    @limit_rate(2, timedelta(seconds=1), burst=4)
+    def limited():
+        starts.append(clock[0])
+
+    for _ in range(6):
+        limited()
+    assert starts == [0, 0, 0, 0, 0.5, 1]
+
+    clock[0] = 10
+    del starts[:]
+    for _ in range(5):
+        limited()
+    assert starts == [10, 10, 10, 10, 10.5]
+
+
+def test_limit_rate_sliding_window(clock):
+    starts = []
+
+    @limit_rate(2, 1, algorithm='sliding_window')
+    def limited():
+        starts.append(clock[0])
+        clock[0] += 0.25
+
+    for _ in range(5):
+        limited()
+    assert starts == [0, 0.25, 1, 1.25, 2]
+
+
+def test_limit_rate_reject(clock):
+    @limit_rate(1, 1, wait=False)
+    def limited():
+        pass
+
+    limited()
+    with pytest.raises(RateLimitExceeded): limited()
+    clock[0] = 1
+    limited()
+
+    with pytest.raises(ValueError):
+        limit_rate(1, burst=2, algorithm='sliding_window')
+
+
+def test_limit_rate_async(monkeypatch, clock):
+    async def sleep(seconds):
+        clock[0] += seconds
+    monkeypatch.setattr('asyncio.sleep', sleep)
+    starts = []
+
+    @limit_rate(10)
+    async def limited():
+        starts.append(clock[0])
+
+    async def main():
+        for _ in range(12):
+            await limited()
+
+    asyncio.run(main())
+    assert starts == [0] * 10 + [pytest.approx(0.1), pytest.approx(0.2)]
+
+
+def test_limit_rate_threads():
+    @limit_rate(1, timedelta(hours=1), wait=False)
+    def limited():
+        pass
+
+    results = []
+
+    def call():
+        try:
+            limited()
+            results.append(True)
+        except RateLimitExceeded:
+            results.append(False)
+
+    threads = [threading.Thread(target=call) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results.count(True) == 1
+
+
 @pytest.mark.parametrize('typ',
     [pytest.param(int, id='int'), pytest.param(lambda s: timedelta(seconds=s), id='timedelta')])
 def test_throttle(monkeypatch, typ):
@@ -181,6 +472,122 @@ def test_throttle_class():
     assert throttle(1)(a.foo)() == 42
 
 
+def test_throttle_trailing(wall_clock):
+    calls = []
+
+    @throttle(1, trailing=True)
+    def throttled(x):
+        calls.append(x)
+
+    throttled(1)
+    throttled(2)
+    throttled(3)
+    assert calls == [1]
+    throttled.flush()  # Same as timer firing
+    assert calls == [1, 3]
+
+    wall_clock[0] = 0.5
+    throttled(4)  # Blocked by trailing call
+    wall_clock[0] = 1.5
+    throttled(5)  # Makes skipped call obsolete
+    throttled.flush()
+    assert calls == [1, 3, 5]
+
+
+def test_throttle_trailing_timer():
+    calls = []
+    done = threading.Event()
+
+    @throttle(0.01, trailing=True)
+    def throttled(x):
+        calls.append(x)
+        if x == 3:
+            done.set()
+
+    for x in range(4):
+        throttled(x)
+    assert done.wait(1)
+    assert calls == [0, 3]
+
+
+def test_debounce():
+    calls = []
+    done = threading.Event()
+
+    @debounce(timedelta(milliseconds=10))
+    def debounced(x):
+        calls.append(x)
+        done.set()
+
+    for x in range(3):
+        debounced(x)
+    assert calls == []
+    assert done.wait(1)
+    assert calls == [2]
+
+    debounced(3)
+    debounced.cancel()
+    assert debounced.flush() is None
+    debounced(4)
+    debounced.flush()
+    assert calls == [2, 4]
+
+
+def test_debounce_single_timer(monkeypatch):
+    timers = []
+
+    class Timer(threading.Timer):
+        def start(self):
+            timers.append(self)
+            super().start()
+    monkeypatch.setattr('threading.Timer', Timer)
+    calls = []
+
+    @debounce(60)
+    def debounced(x):
+        calls.append(x)
+
+    try:
+        for x in range(100):
+            debounced(x)
+        assert len(timers) == 1
+    finally:
+        debounced.flush()
+    assert calls == [99]
+
+
+def test_debounce_async():
+    calls = []
+
+    @debounce(0.01)
+    async def debounced(x):
+        calls.append(x)
+
+    async def main():
+        for x in range(3):
+            await debounced(x)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    assert calls == [2]
+
+
+def test_throttle_trailing_async():
+    calls = []
+
+    @throttle(0.01, trailing=True)
+    async def throttled(x):
+        calls.append(x)
+
+    async def main():
+        for x in range(3):
+            await throttled(x)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    assert calls == [0, 2]
+
+
 def test_post_processing():
     @post_processing(max)
     def my_max(l):